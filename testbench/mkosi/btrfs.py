@@ -1,15 +1,64 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+import fcntl
 import os
+import struct
 from subprocess import DEVNULL, PIPE, run
+from typing import Sequence, Tuple
 
 from .ui import run_visible
 
+# _IOW(BTRFS_IOCTL_MAGIC, 1, struct btrfs_ioctl_vol_args)
+BTRFS_IOC_SNAP_CREATE = 0x50009401
+# _IOW(BTRFS_IOCTL_MAGIC, 14, struct btrfs_ioctl_vol_args)
+BTRFS_IOC_SUBVOL_CREATE = 0x5000940E
+# struct btrfs_ioctl_vol_args { __s64 fd; char name[BTRFS_PATH_NAME_MAX + 1]; }
+BTRFS_IOCTL_VOL_ARGS = struct.Struct("q4088s")
+# The root directory of a btrfs subvolume always has this inode number
+# (BTRFS_FIRST_FREE_OBJECTID).
+BTRFS_SUBVOL_INO = 256
+
+def btrfs_subvol_create_batch(parent_fd: int, subvols: Sequence[Tuple[str, int]]) -> None:
+    """Create subvolumes relative to an open directory, in order
+
+    Each entry is a (path, mode) pair; paths may point into subvolumes
+    created earlier in the same batch.
+    """
+    for path, mode in subvols:
+        dirname, name = os.path.split(path)
+        fd = os.open(dirname, os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC, dir_fd=parent_fd) if dirname else parent_fd
+        m = os.umask(~mode & 0o7777)
+        try:
+            # A mutable buffer, immutable ones are limited to 1024 bytes
+            fcntl.ioctl(fd, BTRFS_IOC_SUBVOL_CREATE, bytearray(BTRFS_IOCTL_VOL_ARGS.pack(0, os.fsencode(name))))
+        finally:
+            os.umask(m)
+            if fd != parent_fd:
+                os.close(fd)
 
 def btrfs_subvol_create(path: str, mode: int=0o755) -> None:
-    m = os.umask(~mode & 0o7777)
-    run_visible(["btrfs", "subvol", "create", path], check=True)
-    os.umask(m)
+    fd = os.open(os.path.dirname(path) or ".", os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC)
+    try:
+        btrfs_subvol_create_batch(fd, [(os.path.basename(path), mode)])
+    finally:
+        os.close(fd)
+
+def btrfs_subvol_snapshot(src: str, dst: str) -> None:
+    """Create dst as a writable snapshot of the subvolume src
+
+    Nested subvolumes are not part of the snapshot, they show up as empty
+    placeholder directories in dst.
+    """
+    srcfd = os.open(src, os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC)
+    try:
+        fd = os.open(os.path.dirname(dst) or ".", os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC)
+        try:
+            fcntl.ioctl(fd, BTRFS_IOC_SNAP_CREATE,
+                        bytearray(BTRFS_IOCTL_VOL_ARGS.pack(srcfd, os.fsencode(os.path.basename(dst)))))
+        finally:
+            os.close(fd)
+    finally:
+        os.close(srcfd)
 
 def btrfs_subvol_delete(path: str) -> None:
     # Extract the path of the subvolume relative to the filesystem
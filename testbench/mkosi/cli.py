@@ -74,7 +74,14 @@ def parse_args() -> CommandLineArguments:
     group.add_argument("--secure-boot-certificate", help="UEFI SecureBoot certificate in X509 format", metavar='PATH')
     group.add_argument("--read-only", action='store_true', help='Make root volume read-only (only raw_ext4, raw_btrfs, subvolume, implied on raw_squashs)')
     group.add_argument("--encrypt", choices=("all", "data"), help='Encrypt everything except: ESP ("all") or ESP and root ("data")')
+    group.add_argument("--luks-bypass-workqueues", type=parse_boolean, nargs='?', const=True,
+                       help='Bypass the dm-crypt read/write workqueues when opening encrypted partitions (needs cryptsetup >= 2.3.4 and Linux >= 5.9)')
+    group.add_argument("--luks-pbkdf-memory", type=int, help='Memory cost of the argon2id key derivation of the LUKS2 volumes (default: 65536)', metavar='KIB')
+    group.add_argument("--luks-pbkdf-parallel", type=int, help='Number of threads for the argon2id key derivation of the LUKS2 volumes (default: 1)', metavar='THREADS')
     group.add_argument("--verity", action='store_true', help='Add integrity partition (implies --read-only)')
+    # Compute the integrity hash tree in-process instead of with
+    # veritysetup; experimental, so not advertised in --help
+    group.add_argument("--verity-builtin", action='store_true', help=argparse.SUPPRESS)
     group.add_argument("--compress", action='store_true', help='Enable compression in file system (only raw_btrfs, subvolume)')
     group.add_argument("--xz", action='store_true', help='Compress resulting image with xz (only raw_ext4, raw_btrfs, raw_squashfs, raw_xfs, implied on tar)')
     group.add_argument("--qcow2", action='store_true', help='Convert resulting image to qcow2 (only raw_ext4, raw_btrfs, raw_squashfs, raw_xfs)')
@@ -207,6 +214,12 @@ def detect_distribution() -> Tuple[Optional[str], Optional[str]]:
 
     return d, version_id
 
+def parse_int_setting(key: str, value: str) -> int:
+    try:
+        return int(value)
+    except ValueError:
+        die("Invalid value for {}: {!r}".format(key, value))
+
 def parse_boolean(s: str) -> bool:
     "Parse 1/true/yes as true and 0/false/no as false"
     if s in {"1", "true", "yes"}:
@@ -274,9 +287,21 @@ def process_setting(args: CommandLineArguments, section: str, key: Optional[str]
                 if value not in ("all", "data"):
                     raise ValueError("Invalid encryption setting: " + value)
                 args.encrypt = value
+        elif key == "LUKSBypassWorkqueues":
+            if args.luks_bypass_workqueues is None:
+                args.luks_bypass_workqueues = parse_boolean(value)
+        elif key == "LUKSPBKDFMemory":
+            if args.luks_pbkdf_memory is None:
+                args.luks_pbkdf_memory = parse_int_setting(key, value)
+        elif key == "LUKSPBKDFParallel":
+            if args.luks_pbkdf_parallel is None:
+                args.luks_pbkdf_parallel = parse_int_setting(key, value)
         elif key == "Verity":
             if args.verity is None:
                 args.verity = parse_boolean(value)
+        elif key == "VerityBuiltin":
+            if args.verity_builtin is None:
+                args.verity_builtin = parse_boolean(value)
         elif key == "Compress":
             if args.compress is None:
                 args.compress = parse_boolean(value)
@@ -639,12 +664,26 @@ def load_args() -> CommandLineArguments:
         if args.output_format not in RAW_FORMATS:
             die("Encryption is only supported for raw ext4, btrfs or squashfs images.")
 
-        if args.encrypt == "data" and args.output_format == OutputFormat.raw_btrfs:
+        if args.encrypt == "data" and args.output_format is OutputFormat.raw_btrfs:
             die("'data' encryption mode not supported on btrfs, use 'all' instead.")
 
         if args.encrypt == "all" and args.verity:
             die("'all' encryption mode may not be combined with Verity.")
 
+    if args.luks_bypass_workqueues is None:
+        args.luks_bypass_workqueues = False
+
+    if args.luks_pbkdf_memory is None:
+        args.luks_pbkdf_memory = 64*1024  # 64MiB
+    elif not 32 <= args.luks_pbkdf_memory <= 4*1024*1024:
+        # The range cryptsetup accepts for argon2
+        die("LUKS PBKDF memory cost must be between 32 and 4194304 KiB.")
+
+    if args.luks_pbkdf_parallel is None:
+        args.luks_pbkdf_parallel = 1
+    elif not 1 <= args.luks_pbkdf_parallel <= 4:
+        die("LUKS PBKDF parallelism must be between 1 and 4 threads.")
+
     if args.sign:
         args.checksum = True
 
@@ -657,7 +696,7 @@ def load_args() -> CommandLineArguments:
 
             if args.xz:
                 args.output += ".xz"
-        elif args.output_format == OutputFormat.tar:
+        elif args.output_format is OutputFormat.tar:
             args.output = "image.tar.xz"
         else:
             args.output = "image"
@@ -678,11 +717,12 @@ def load_args() -> CommandLineArguments:
         args.cache_pre_inst = None
 
     args.output = os.path.abspath(args.output)
+    args.output_dirname = os.path.dirname(args.output)
 
-    if args.output_format == OutputFormat.tar:
+    if args.output_format is OutputFormat.tar:
         args.xz = True
 
-    if args.output_format == OutputFormat.raw_squashfs:
+    if args.output_format is OutputFormat.raw_squashfs:
         args.read_only = True
         args.compress = True
         args.root_size = None
@@ -692,10 +732,10 @@ def load_args() -> CommandLineArguments:
         args.output_root_hash_file = build_root_hash_file_path(args.output)
 
     if args.checksum:
-        args.output_checksum = os.path.join(os.path.dirname(args.output), "SHA256SUMS")
+        args.output_checksum = os.path.join(args.output_dirname, "SHA256SUMS")
 
     if args.sign:
-        args.output_signature = os.path.join(os.path.dirname(args.output), "SHA256SUMS.gpg")
+        args.output_signature = os.path.join(args.output_dirname, "SHA256SUMS.gpg")
 
     if args.bmap:
         args.output_bmap = args.output + ".bmap"
@@ -736,7 +776,7 @@ def load_args() -> CommandLineArguments:
     if args.output_format in (OutputFormat.raw_ext4, OutputFormat.raw_btrfs) and args.root_size is None:
         args.root_size = 1024*1024*1024  # 1GiB
 
-    if args.output_format == OutputFormat.raw_xfs and args.root_size is None:
+    if args.output_format is OutputFormat.raw_xfs and args.root_size is None:
         args.root_size = 1300*1024*1024  # 1.27GiB
 
     if args.bootable and args.esp_size is None:
@@ -761,7 +801,7 @@ def load_args() -> CommandLineArguments:
             die("UEFI SecureBoot enabled, but couldn't find certificate. (Consider placing it in mkosi.secure-boot.crt?)")
 
     if args.verb in ("shell", "boot", "qemu"):
-        if args.output_format == OutputFormat.tar:
+        if args.output_format is OutputFormat.tar:
             die("Sorry, can't acquire shell in or boot a tar archive.")
         if args.xz:
             die("Sorry, can't acquire shell in or boot an XZ compressed image.")
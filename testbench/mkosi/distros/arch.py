@@ -151,11 +151,11 @@ SigLevel    = Required DatabaseOptional
         warn('More than one kernel will be installed: {}', ' '.join(kernel_packages))
 
     if args.bootable:
-        if args.output_format == OutputFormat.raw_ext4:
+        if args.output_format is OutputFormat.raw_ext4:
             packages.add("e2fsprogs")
-        elif args.output_format == OutputFormat.raw_btrfs:
+        elif args.output_format is OutputFormat.raw_btrfs:
             packages.add("btrfs-progs")
-        elif args.output_format == OutputFormat.raw_xfs:
+        elif args.output_format is OutputFormat.raw_xfs:
             packages.add("xfsprogs")
         if args.encrypt:
             packages.add("cryptsetup")
@@ -22,7 +22,7 @@ def debootstrap(args: CommandLineArguments, workspace: str, run_build_script: bo
                args.release,
                workspace + "/root",
                mirror]
-    if args.bootable and args.output_format == OutputFormat.raw_btrfs:
+    if args.bootable and args.output_format is OutputFormat.raw_btrfs:
         cmdline[4] += ",btrfs-tools"
 
     run_visible(cmdline, check=True)
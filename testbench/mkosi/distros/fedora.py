@@ -7,7 +7,7 @@ from typing import Optional
 from ..rpm import disable_kernel_install, invoke_dnf, reenable_kernel_install
 from ..types import CommandLineArguments
 from ..ui import complete_step, warn
-from ..utils import check_if_url_exists
+from ..utils import check_urls_exist
 
 FEDORA_KEYS_MAP = {
     '23': '34EC9CBA',
@@ -46,9 +46,15 @@ def install(args: CommandLineArguments, workspace: str, run_build_script: bool)
         gpg_key = "https://getfedora.org/static/%s.txt" % FEDORA_KEYS_MAP[args.releasever]
 
     if args.mirror:
-        baseurl = "{args.mirror}/releases/{args.release}/Everything/x86_64/os/".format(args=args)
-        if not check_if_url_exists("%s/media.repo" % baseurl):
-            baseurl = "{args.mirror}/development/{args.release}/Everything/x86_64/os/".format(args=args)
+        releases_url = "{args.mirror}/releases/{args.release}/Everything/x86_64/os/".format(args=args)
+        development_url = "{args.mirror}/development/{args.release}/Everything/x86_64/os/".format(args=args)
+        # Probe both trees at once; the mirror round trip dominates here.
+        exists = check_urls_exist(["%s/media.repo" % releases_url,
+                                   "%s/media.repo" % development_url])
+        if exists["%s/media.repo" % releases_url]:
+            baseurl = releases_url
+        else:
+            baseurl = development_url
 
         release_url = "baseurl=%s" % baseurl
         updates_url = "baseurl={args.mirror}/updates/{args.release}/x86_64/".format(args=args)
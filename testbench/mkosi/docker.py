@@ -7,17 +7,26 @@
 # mechanism.
 
 import importlib
+import importlib.abc
+import importlib.machinery
+import importlib.util
 import pickle
 import pkgutil
+import struct
 import sys
-from io import BytesIO
+from subprocess import PIPE
 from types import ModuleType
-from typing import Any, BinaryIO, Callable, List, Optional, Union
+from typing import Any, BinaryIO, Callable, Dict, List, Optional, Union, cast
 
-from .ui import run_visible
+from .ui import popen_visible
 
 # The complement to serialize_module()/serialize_end() is the parser
 # in StreamImporter() in docker_stage2.py.
+#
+# Each module is framed by a fixed-size header (is_package,
+# len(name), len(body)), followed by the name and the body.  A header
+# with an empty name marks the end of the modules.
+MODULE_HEADER = struct.Struct('<?II')
 
 def serialize_module(writer: BinaryIO, module_name: str) -> None:
     spec = importlib.util.find_spec(module_name)
@@ -25,20 +34,34 @@ def serialize_module(writer: BinaryIO, module_name: str) -> None:
         raise RuntimeError('Unknown module "%s".' % module_name)
     assert isinstance(spec.loader, importlib.abc.InspectLoader)
 
-    body = spec.loader.get_source(module_name)
-    assert body is not None
-    encoded_body = body.encode('utf-8')
-
-    writer.write(b'%s\n%s\n%d\n%s' % (
-        module_name.encode('utf-8'),  # name
-        (b'False' if spec.submodule_search_locations is None else b'True'),  # is_package
-        len(encoded_body),  # len(body)
-        encoded_body))  # body
+    encoded_name = module_name.encode('utf-8')
+    if isinstance(spec.loader, importlib.machinery.SourceFileLoader):
+        # Send the file as-is, rather than having get_source() decode
+        # it only for us to encode it right back again.  (Only for
+        # source files: a SourcelessFileLoader's file is bytecode.)
+        encoded_body = spec.loader.get_data(spec.loader.get_filename(module_name))
+    else:
+        body = spec.loader.get_source(module_name)
+        assert body is not None
+        encoded_body = body.encode('utf-8')
+
+    writer.write(MODULE_HEADER.pack(spec.submodule_search_locations is not None,  # is_package
+                                    len(encoded_name),
+                                    len(encoded_body)))
+    writer.write(encoded_name)
+    writer.write(encoded_body)
 
 def serialize_end(writer: BinaryIO) -> None:
-    writer.write(b'\n')
+    writer.write(MODULE_HEADER.pack(False, 0, 0))
+
+_walk_package_cache: Dict[str, List[str]] = {}
 
 def walk_package(package: ModuleType) -> List[str]:
+    # pkgutil.walk_packages() has to import every subpackage to find
+    # its children, so only do it once per package.
+    if package.__name__ in _walk_package_cache:
+        return _walk_package_cache[package.__name__]
+
     # Assert that it is a package
     assert hasattr(package, '__path__')
 
@@ -51,9 +74,14 @@ def walk_package(package: ModuleType) -> List[str]:
     while '.' in ancestry[-1]:
         ancestry.append(ancestry[-1].rsplit('.', 1)[0])
 
-    return ancestry + members
+    _walk_package_cache[package.__name__] = ancestry + members
+    return _walk_package_cache[package.__name__]
 
-def run_in_docker(fn: Callable[..., None], args: List[Any]=[], docker_args: List[str]=[]) -> None:
+def run_in_docker(fn: Callable[..., None], args: Optional[List[Any]]=None, docker_args: Optional[List[str]]=None) -> None:
+    if args is None:
+        args = []
+    if docker_args is None:
+        docker_args = []
 
     # We do this in multiple stages because: The first stage (whether
     # or not there are more after it) is sent over argv, which means
@@ -72,22 +100,29 @@ def run_in_docker(fn: Callable[..., None], args: List[Any]=[], docker_args: List
     #  1. Read stage2 from stdin and execute it
     stage1: bytes = ("import os, sys; sys.stdin = os.fdopen(0, 'rb'); exec(compile(sys.stdin.read(%d), 'docker_stage2.py', 'exec'))" % len(stage2)).encode("utf-8")
 
-    stdin = BytesIO()
-    # Send stage2 for stage1 to read
-    stdin.write(stage2)
-    # Send modules for stage2 to read
-    for module_name in walk_package(importlib.import_module(__package__)):
-        serialize_module(stdin, module_name)
-    serialize_end(stdin)
-    # Send function's __module__/__name__/arguments for stage2 to read
-    stdin.write(("%s\n%s\n" % (fn.__module__, fn.__name__)).encode("utf-8"))
-    pickle.dump(args, stdin)
-
     cmdline: List[Union[bytes, str]] = [
         "docker", "run", "--interactive", "--rm", *docker_args,
         "gcr.io/datawireio/testbench-mkosi",
         "python3", "-c", stage1,
     ]
-    proc = run_visible(cmdline, input=stdin.getvalue())
+    # Stream everything to the container as it is serialized, so that
+    # the container can start up while we're still working.
+    with popen_visible(cmdline, stdin=PIPE, bufsize=1024*1024) as proc:
+        stdin = cast(BinaryIO, proc.stdin)
+        try:
+            # Send stage2 for stage1 to read
+            stdin.write(stage2)
+            # Send modules for stage2 to read
+            for module_name in walk_package(importlib.import_module(__package__)):
+                serialize_module(stdin, module_name)
+            serialize_end(stdin)
+            # Send function's __module__/__name__/arguments for stage2 to read
+            stdin.write(("%s\n%s\n" % (fn.__module__, fn.__name__)).encode("utf-8"))
+            pickle.dump(args, stdin)
+            stdin.close()
+        except BrokenPipeError:
+            # The container went away early; its exit status is what
+            # we care about, and that gets handled below.
+            pass
     if proc.returncode != 0:
         sys.exit(proc.returncode)
@@ -15,6 +15,7 @@ syntax-hightlights it, and flake8 lints it.
 
 import importlib
 import pickle
+import struct
 import sys
 from importlib import abc
 from importlib.machinery import ModuleSpec
@@ -22,6 +23,9 @@ from types import CodeType, ModuleType
 from typing import BinaryIO, Dict, Optional, Sequence, Tuple, Union, cast
 
 
+# Must match MODULE_HEADER in docker.py.
+MODULE_HEADER = struct.Struct('<?II')
+
 class StreamImporter(abc.MetaPathFinder, abc.InspectLoader):
     # Gotchas:
     #
@@ -47,12 +51,11 @@ class StreamImporter(abc.MetaPathFinder, abc.InspectLoader):
         # serialize_module()/serialize_end() in docker.py.
         while True:
             # Read a module from the stream
-            name = reader.readline().strip().decode('utf-8')
-            if not name:
+            is_pkg, name_len, body_len = MODULE_HEADER.unpack(reader.read(MODULE_HEADER.size))
+            if name_len == 0:
                 return
-            is_pkg = reader.readline().strip().decode('utf-8') == 'True'
-            nbytes = int(reader.readline().strip().decode('utf-8'))
-            body = reader.read(nbytes).decode('utf-8')
+            name = reader.read(name_len).decode('utf-8')
+            body = reader.read(body_len).decode('utf-8')
             # And save it to self.sources, for later evaluation at
             # import-time
             self.sources[name] = (is_pkg, body)
@@ -81,6 +84,13 @@ class StreamImporter(abc.MetaPathFinder, abc.InspectLoader):
             return None
         return self.source_to_code(source, "{}:{}.py".format(self.origin, fullname))
 
+    @staticmethod
+    def source_to_code(data: Union[bytes, str], path: str='<string>') -> CodeType:  # type: ignore # typeshed declares a narrower signature
+        # Like the default InspectLoader.source_to_code(), but without
+        # inheriting this module's __future__ flags.  Keep the asserts:
+        # the code relies on them, and should behave as on the host.
+        return compile(data, path, 'exec', dont_inherit=True, optimize=-1)
+
 def stage2(reader: BinaryIO) -> None:
     # Load modules
     sys.meta_path.insert(0, StreamImporter(reader))
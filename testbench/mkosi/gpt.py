@@ -1,11 +1,16 @@
+import io
+import os
 import platform
 import re
+import stat
 import string
+import struct
 import uuid
-from subprocess import PIPE
-from typing import Dict, List, NamedTuple, Optional, Tuple
+import zlib
+from subprocess import PIPE, CalledProcessError
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
 
-from .ui import die, run_visible
+from .ui import die, popen_visible, run_visible
 
 # This file is tailored to Linux/util-linux, and will need to be
 # essentially rewritten for Darwin/diskutil.
@@ -34,18 +39,23 @@ class GPTRootTypePair(NamedTuple):
     root: uuid.UUID
     verity: uuid.UUID
 
+_NATIVE_MACHINE = platform.machine()
+
+_NATIVE_ROOT_BY_MACHINE: Dict[str, GPTRootTypePair] = {
+    "x86_64": GPTRootTypePair(GPT_ROOT_X86_64, GPT_ROOT_X86_64_VERITY),
+    "aarch64": GPTRootTypePair(GPT_ROOT_ARM_64, GPT_ROOT_ARM_64_VERITY),
+}
+
 def gpt_root_native() -> GPTRootTypePair:
     """The tag for the native GPT root partition
 
     Returns a tuple of two tags: for the root partition and for the
     matching verity partition.
     """
-    if platform.machine() == "x86_64":
-        return GPTRootTypePair(GPT_ROOT_X86_64, GPT_ROOT_X86_64_VERITY)
-    elif platform.machine() == "aarch64":
-        return GPTRootTypePair(GPT_ROOT_ARM_64, GPT_ROOT_ARM_64_VERITY)
-    else:
-        die("Unknown architecture {}.".format(platform.machine()))
+    pair = _NATIVE_ROOT_BY_MACHINE.get(_NATIVE_MACHINE)
+    if pair is None:
+        die("Unknown architecture {}.".format(_NATIVE_MACHINE))
+    return pair
 
 def sfdisk_quote_char(c: int) -> str:
     # Hex-escape non-(printable-ASCII) bytes, as well as (dquote,
@@ -75,6 +85,7 @@ def sfdisk_unquote(s: str) -> str:
             else:
                 ret += rest[0]
                 rest = rest[1:]
+        return ret
     return s
 
 class Partition(NamedTuple):
@@ -89,21 +100,31 @@ class Partition(NamedTuple):
     def __str__(self) -> str:
         fields: List[str] = []
         if self.p_start is not None:
-            fields.append("start={}".format(self.p_start))
+            fields.append("start=" + str(self.p_start))
         if self.p_size is not None:
-            fields.append("size={}".format(self.p_size))
+            fields.append("size=" + str(self.p_size))
         if self.p_type is not None:
-            fields.append("type={}".format(self.p_type))
+            fields.append("type=" + str(self.p_type))
         if self.p_uuid is not None:
-            fields.append("uuid={}".format(self.p_uuid))
+            fields.append("uuid=" + str(self.p_uuid))
         if self.p_name is not None:
-            fields.append("name={}".format(sfdisk_quote(self.p_name)))
+            fields.append("name=" + sfdisk_quote(self.p_name))
         if self.p_attrs is not None:
-            fields.append("attrs={}".format(self.p_attrs))
+            fields.append("attrs=" + self.p_attrs)
         if self.p_bootable:
             fields.append("bootable")
         return ", ".join(fields)
 
+# Maps sfdisk --dump field names to Partition attributes and parsers
+_PARTITION_FIELDS: Dict[str, Tuple[str, Callable[[str], Any]]] = {
+    "start": ("p_start", int),
+    "size": ("p_size", int),
+    "type": ("p_type", uuid.UUID),
+    "uuid": ("p_uuid", uuid.UUID),
+    "name": ("p_name", sfdisk_unquote),
+    "attrs": ("p_attrs", sfdisk_unquote),
+}
+
 def read_partition_table(devpath: str) -> Tuple[Dict[int, Partition], int]:
     """Return a dict of the partitions in the GTP volume at devpath, and
     the location of the last allocated sector"""
@@ -111,72 +132,170 @@ def read_partition_table(devpath: str) -> Tuple[Dict[int, Partition], int]:
     table: Dict[int, Partition] = {}
     last_sector = 0
 
-    c = run_visible(["sfdisk", "--dump", devpath], stdout=PIPE, check=True)
-    in_body = False
-    for line in c.stdout.decode("utf-8").split('\n'):
-        stripped = line.strip()
-
-        if stripped == "":  # empty line is where the body begins
-            in_body = True
-            continue
-        if not in_body:
-            continue
-
-        part_name, rest = stripped.split(":", 1)
-        parn_num = int(re.sub(r".*[^0-9]", '', part_name))
-        # BUG: this won't correctly handle a comma inside of a quoted name= field
-        fields = rest.split(",")
-
-        partition = Partition()
-        for field in fields:
-            f = field.strip()
-
-            p_start: Optional[int] = None
-            p_size: Optional[int] = None
-            p_type: Optional[uuid.UUID] = None
-            p_uuid: Optional[uuid.UUID] = None
-            p_name: Optional[str] = None
-            p_attrs: Optional[str] = None
-            p_bootable: bool = False
-
-            if f.startswith("start="):
-                p_start = int(f[6:])
-            if f.startswith("size="):
-                p_size = int(f[5:])
-            if f.startswith("type="):
-                p_type = uuid.UUID(f[5:])
-            if f.startswith("uuid="):
-                p_uuid = uuid.UUID(f[5:])
-            if f.startswith("name="):
-                p_name = sfdisk_unquote(f[5:])
-            if f.startswith("attrs="):
-                p_attrs = f[6:]
-            if f == "bootable":
-                p_bootable = True
-
-        table[parn_num] = Partition(p_start=p_start,
-                                    p_size=p_size,
-                                    p_type=p_type,
-                                    p_uuid=p_uuid,
-                                    p_name=p_name,
-                                    p_attrs=p_attrs,
-                                    p_bootable=p_bootable)
-
-        if partition.p_start is not None and partition.p_size is not None:
-            end = partition.p_start + partition.p_size
-            if end > last_sector:
-                last_sector = end
+    # Stream the dump rather than buffering all of it; force the C
+    # locale so that the output format is stable.
+    cmdline = ["sfdisk", "--dump", devpath]
+    with popen_visible(cmdline, stdout=PIPE, env=dict(os.environ, LC_ALL="C")) as proc:
+        assert proc.stdout is not None
+        in_body = False
+        for line in io.TextIOWrapper(proc.stdout, encoding="utf-8"):
+            stripped = line.strip()
+
+            if stripped == "":  # empty line is where the body begins
+                in_body = True
+                continue
+            if not in_body:
+                continue
+
+            part_name, rest = stripped.split(":", 1)
+            parn_num = int(re.sub(r".*[^0-9]", '', part_name.strip()))
+            # BUG: this won't correctly handle a comma inside of a quoted name= field
+            fields = rest.split(",")
+
+            values: Dict[str, Any] = {}
+            for field in fields:
+                key, sep, value = field.strip().partition("=")
+                if not sep:
+                    if key == "bootable":
+                        values["p_bootable"] = True
+                    continue
+                parser = _PARTITION_FIELDS.get(key)
+                if parser is None:
+                    continue
+                attr, parse = parser
+                values[attr] = parse(value)
+
+            partition = Partition(**values)
+            table[parn_num] = partition
+
+            if partition.p_start is not None and partition.p_size is not None:
+                end = partition.p_start + partition.p_size
+                if end > last_sector:
+                    last_sector = end
+
+    if proc.returncode != 0:
+        raise CalledProcessError(proc.returncode, cmdline)
 
     return table, last_sector * 512
 
+GPT_SECTOR_SIZE = 512
+# sfdisk's default alignment: 1 MiB
+_GPT_GRAIN = 2048
+_GPT_ENTRY_COUNT = 128
+_GPT_HEADER = struct.Struct("<8sIIIIQQQQ16sQIII")
+_GPT_ENTRY = struct.Struct("<16s16sQQQ72s")
+_GPT_ENTRIES_SECTORS = _GPT_ENTRY_COUNT * _GPT_ENTRY.size // GPT_SECTOR_SIZE
+_MBR_PROTECTIVE_ENTRY = struct.Struct("<B3sB3sII")
+
+_GPT_ATTRIBUTE_BITS = {
+    "RequiredPartition": 0,
+    "NoBlockIOProtocol": 1,
+    "LegacyBIOSBootable": 2,
+}
+
+def _gpt_attributes(attrs: Optional[str]) -> int:
+    """Parse an sfdisk attrs= string, such as "GUID:60" """
+    bits = 0
+    for word in re.split(r"[ ,]+", attrs or ""):
+        if word in _GPT_ATTRIBUTE_BITS:
+            bits |= 1 << _GPT_ATTRIBUTE_BITS[word]
+        elif word.startswith("GUID:"):
+            bits |= 1 << int(word[5:])
+        elif word.isdigit():
+            # continuation of a "GUID:52,53" list
+            bits |= 1 << int(word)
+        elif word:
+            raise ValueError("Unknown GPT partition attribute " + word)
+    return bits
+
+def _gpt_header(sectors: int, my_lba: int, alt_lba: int, entries_lba: int, disk_uuid: uuid.UUID, entries_crc: int) -> bytes:
+    fields = [b"EFI PART", 0x00010000, _GPT_HEADER.size, 0, 0,
+              my_lba, alt_lba,
+              2 + _GPT_ENTRIES_SECTORS, sectors - 2 - _GPT_ENTRIES_SECTORS,
+              disk_uuid.bytes_le, entries_lba,
+              _GPT_ENTRY_COUNT, _GPT_ENTRY.size, entries_crc]
+    fields[3] = zlib.crc32(_GPT_HEADER.pack(*fields))
+    return _GPT_HEADER.pack(*fields).ljust(GPT_SECTOR_SIZE, b"\0")
+
+def pack_partition_table(table: Dict[int, Partition], size: int) -> Tuple[bytes, bytes]:
+    """Lay out table the way sfdisk would on a disk of size bytes
+
+    Returns the data for the start of the disk (protective MBR, primary
+    header and entries) and for its last sectors (backup entries and
+    header).
+    """
+    sectors = size // GPT_SECTOR_SIZE
+    last_usable = sectors - 2 - _GPT_ENTRIES_SECTORS
+
+    entries = bytearray(_GPT_ENTRY_COUNT * _GPT_ENTRY.size)
+    cursor = _GPT_GRAIN
+    for partno in sorted(table):
+        p = table[partno]
+        start = p.p_start if p.p_start is not None else -(-cursor // _GPT_GRAIN) * _GPT_GRAIN
+        if p.p_size is not None:
+            end = start + p.p_size - 1
+        else:
+            # Fill the rest of the disk; like sfdisk, run right up to the
+            # last usable sector rather than rounding the end down
+            end = last_usable
+        if end > last_usable:
+            raise ValueError("Partition {} does not fit on the disk".format(partno))
+        cursor = end + 1
+
+        assert p.p_type is not None
+        _GPT_ENTRY.pack_into(entries, (partno - 1) * _GPT_ENTRY.size,
+                             p.p_type.bytes_le,
+                             (p.p_uuid or uuid.uuid4()).bytes_le,
+                             start, end,
+                             _gpt_attributes(p.p_attrs) | (1 << 2 if p.p_bootable else 0),
+                             (p.p_name or "").encode("utf-16-le")[:72])
+
+    entries_crc = zlib.crc32(entries)
+    disk_uuid = uuid.uuid4()
+
+    mbr = bytearray(GPT_SECTOR_SIZE)
+    _MBR_PROTECTIVE_ENTRY.pack_into(mbr, 446, 0x00, b"\x00\x02\x00", 0xEE, b"\xff\xff\xff",
+                                    1, min(sectors - 1, 0xFFFFFFFF))
+    mbr[510:512] = b"\x55\xaa"
+
+    primary = bytes(mbr) + _gpt_header(sectors, 1, sectors - 1, 2, disk_uuid, entries_crc) + bytes(entries)
+    backup = bytes(entries) + _gpt_header(sectors, sectors - 1, 1, sectors - 1 - _GPT_ENTRIES_SECTORS, disk_uuid, entries_crc)
+    return primary, backup
+
+def _write_partition_table_file(path: str, table: Dict[int, Partition]) -> None:
+    fd = os.open(path, os.O_WRONLY | os.O_CLOEXEC)
+    try:
+        size = os.fstat(fd).st_size
+        primary, backup = pack_partition_table(table, size)
+        os.pwrite(fd, primary, 0)
+        os.pwrite(fd, backup, size // GPT_SECTOR_SIZE * GPT_SECTOR_SIZE - len(backup))
+        os.fdatasync(fd)
+    finally:
+        os.close(fd)
+
 def write_partition_table(devpath: str, table: Dict[int, Partition]) -> None:
 
-    txt = "label: gpt\n"
-    for part_num, part_info in table.items():
-        txt += "%s : %s\n" % (ensured_partition(devpath, part_num), str(part_info))
+    # An image file that no kernel has attached yet: nobody needs to be
+    # told about the new partitions, so write the label ourselves
+    # rather than running sfdisk.
+    if stat.S_ISREG(os.stat(devpath).st_mode):
+        _write_partition_table_file(devpath, table)
+        return
+
+    lines = ["label: gpt"]
+    lines.extend(ensured_partition(devpath, part_num) + " : " + str(part_info)
+                 for part_num, part_info in table.items())
+    txt = "\n".join(lines) + "\n"
 
     run_visible(["sfdisk", "--color=never", devpath], input=txt.encode("utf-8"), check=True)
-    run_visible(["sync"])
+
+    # Only flush the device we wrote to, rather than sync(1)ing every
+    # dirty buffer on the host.
+    fd = os.open(devpath, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        os.fdatasync(fd)
+    finally:
+        os.close(fd)
 
 def partition(devpath: str, partno: Optional[int]) -> Optional[str]:
     if partno is None:
@@ -1,6 +1,7 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
 import contextlib
+import functools
 import os
 import os.path
 import shutil
@@ -8,7 +9,7 @@ from typing import Iterator, List
 
 from .types import CommandLineArguments, OutputFormat
 from .ui import complete_step, run_visible
-from .utils import mkdir_last, mount_bind, umount
+from .utils import mkdir_last, mount_bind, sys_umount
 
 
 @contextlib.contextmanager
@@ -16,32 +17,37 @@ def mount_api_vfs(args: CommandLineArguments, workspace: str) -> Iterator[None]:
     paths = ('/proc', '/dev', '/sys')
     root = os.path.join(workspace, "root")
 
+    # These get unmounted after every package manager run, so skip the
+    # umount(8) process and make the syscall directly.
     with complete_step('Mounting API VFS'):
         for d in paths:
             mount_bind(d, root + d)
+    succeeded = False
     try:
         yield
+        succeeded = True
     finally:
+        # Don't let a mount left busy by a failed run replace its error
         with complete_step('Unmounting API VFS'):
             for d in paths:
-                umount(root + d)
+                sys_umount(root + d, check=succeeded)
 
-def invoke_dnf(args: CommandLineArguments, workspace: str, repositories: List[str], base_packages: List[str], boot_packages: List[str], config_file: str, run_build_script: bool=True) -> None:
-
-    repos = ["--enablerepo=" + repo for repo in repositories]
+def invoke_package_manager(binary: str, args: CommandLineArguments, workspace: str, repositories: List[str], base_packages: List[str], boot_packages: List[str], config_file: str, run_build_script: bool) -> None:
 
     root = os.path.join(workspace, "root")
-    cmdline = ["dnf",
+    cmdline = [binary,
                "-y",
                "--config=" + config_file,
-               "--best",
-               "--allowerasing",
                "--releasever=" + args.release,
                "--installroot=" + root,
                "--disablerepo=*",
-               *repos,
-               "--setopt=keepcache=1",
-               "--setopt=install_weak_deps=0"]
+               *["--enablerepo=" + repo for repo in repositories],
+               "--setopt=keepcache=1"]
+
+    if binary == "dnf":
+        cmdline += ["--best",
+                    "--allowerasing",
+                    "--setopt=install_weak_deps=0"]
 
     # Turn off docs, but not during the development build, as dnf currently has problems with that
     if not args.with_docs and not run_build_script:
@@ -64,68 +70,36 @@ def invoke_dnf(args: CommandLineArguments, workspace: str, repositories: List[st
         if args.encrypt or args.verity:
             cmdline.append("cryptsetup")
 
-        if args.output_format == OutputFormat.raw_ext4:
+        if args.output_format is OutputFormat.raw_ext4:
             cmdline.append("e2fsprogs")
 
-        if args.output_format == OutputFormat.raw_xfs:
+        if args.output_format is OutputFormat.raw_xfs:
             cmdline.append("xfsprogs")
 
-        if args.output_format == OutputFormat.raw_btrfs:
+        if args.output_format is OutputFormat.raw_btrfs:
             cmdline.append("btrfs-progs")
 
     with mount_api_vfs(args, workspace):
         run_visible(cmdline, check=True)
 
-def invoke_yum(args: CommandLineArguments, workspace: str, repositories: List[str], base_packages: List[str], boot_packages: List[str], config_file: str, run_build_script: bool=True) -> None:
-
-    repos = ["--enablerepo=" + repo for repo in repositories]
-
-    root = os.path.join(workspace, "root")
-    cmdline = ["yum",
-               "-y",
-               "--config=" + config_file,
-               "--releasever=" + args.release,
-               "--installroot=" + root,
-               "--disablerepo=*",
-               *repos,
-               "--setopt=keepcache=1"]
-
-    # Turn off docs, but not during the development build, as dnf currently has problems with that
-    if not args.with_docs and not run_build_script:
-        cmdline.append("--setopt=tsflags=nodocs")
-
-    cmdline.extend([
-        "install",
-        *base_packages
-    ])
-
-    cmdline.extend(args.packages)
-
-    if run_build_script:
-        cmdline.extend(args.build_packages)
-
-    if args.bootable:
-        cmdline.extend(boot_packages)
-
-        # Temporary hack: dracut only adds crypto support to the initrd, if the cryptsetup binary is installed
-        if args.encrypt or args.verity:
-            cmdline.append("cryptsetup")
+def invoke_dnf(args: CommandLineArguments, workspace: str, repositories: List[str], base_packages: List[str], boot_packages: List[str], config_file: str, run_build_script: bool=True) -> None:
+    invoke_package_manager("dnf", args, workspace, repositories, base_packages, boot_packages, config_file, run_build_script)
 
-        if args.output_format == OutputFormat.raw_ext4:
-            cmdline.append("e2fsprogs")
+def invoke_yum(args: CommandLineArguments, workspace: str, repositories: List[str], base_packages: List[str], boot_packages: List[str], config_file: str, run_build_script: bool=True) -> None:
+    invoke_package_manager("yum", args, workspace, repositories, base_packages, boot_packages, config_file, run_build_script)
 
-        if args.output_format == OutputFormat.raw_btrfs:
-            cmdline.append("btrfs-progs")
-
-    with mount_api_vfs(args, workspace):
-        run_visible(cmdline, check=True)
+@functools.lru_cache(maxsize=None)
+def have_dnf() -> bool:
+    # Looked up lazily, rather than at import time, so that
+    # --extra-search-paths has already been added to $PATH.
+    return shutil.which("dnf") is not None
 
 def invoke_dnf_or_yum(args: CommandLineArguments, workspace: str, repositories: List[str], base_packages: List[str], boot_packages: List[str], config_file: str) -> None:
 
-    if shutil.which("dnf") is None:
-        invoke_yum(args, workspace, repositories, base_packages, boot_packages, config_file)
-    else:
+    if have_dnf():
         invoke_dnf(args, workspace, repositories, base_packages, boot_packages, config_file)
+    else:
+        invoke_yum(args, workspace, repositories, base_packages, boot_packages, config_file)
 
 def disable_kernel_install(args: CommandLineArguments, workspace: str) -> List[str]:
     # Let's disable the automatic kernel installation done by the
@@ -7,7 +7,7 @@ from typing import Optional
 
 class OutputFormat(Enum):
     raw_ext4 = 1
-    raw_gpt = 1  # Kept for backwards compatibility
+    raw_gpt = 1  # Kept for backwards compatibility; an alias of raw_ext4
     raw_btrfs = 2
     raw_squashfs = 3
     directory = 4
@@ -15,6 +15,12 @@ class OutputFormat(Enum):
     tar = 6
     raw_xfs = 7
 
+# Code compares formats by identity, and relies on raw_gpt being the
+# very same member as raw_ext4 (rather than a distinct value).  Make
+# sure that it is the only such alias.
+assert OutputFormat['raw_gpt'] is OutputFormat.raw_ext4
+assert len(set(OutputFormat)) == len(OutputFormat.__members__) - 1
+
 RAW_RW_FS_FORMATS = (
     OutputFormat.raw_ext4,
     OutputFormat.raw_btrfs,
@@ -27,5 +33,10 @@ class CommandLineArguments(argparse.Namespace):
     """Type-hinted storage for command line arguments."""
 
     output: str
+    # os.path.dirname(output), where all outputs and their temporary files go
+    output_dirname: str
     swap_partno: Optional[int] = None
     esp_partno: Optional[int] = None
+    root_partno: Optional[int] = None
+    home_partno: Optional[int] = None
+    srv_partno: Optional[int] = None
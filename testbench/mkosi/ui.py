@@ -1,8 +1,9 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
 import contextlib
+import os
 import sys
-from subprocess import CompletedProcess, run
+from subprocess import CalledProcessError, CompletedProcess, Popen, run
 from typing import Any, Iterator, List, NoReturn, Optional, Sequence, Union
 
 
@@ -14,8 +15,15 @@ def die(message: str, status: int=1) -> NoReturn:
 def warn(message: str, *args: Any, **kwargs: Any) -> None:
     sys.stderr.write('WARNING: ' + message.format(*args, **kwargs) + '\n')
 
+_STEP_PREFIX = "‣ \033[0;1;39m".encode("utf-8")
+_STEP_SUFFIX = b"\033[0m\n"
+
 def print_step(text: str) -> None:
-    sys.stderr.write("‣ \033[0;1;39m" + text + "\033[0m\n")
+    # Flush anything already written through the text layer, then
+    # write the pre-encoded escape sequences straight to the buffer.
+    sys.stderr.flush()
+    sys.stderr.buffer.write(_STEP_PREFIX + text.encode("utf-8") + _STEP_SUFFIX)
+    sys.stderr.buffer.flush()
 
 @contextlib.contextmanager
 def complete_step(text: str, text2: Optional[str]=None) -> Iterator[List[Any]]:
@@ -23,8 +31,9 @@ def complete_step(text: str, text2: Optional[str]=None) -> Iterator[List[Any]]:
     args: List[Any] = []
     yield args
     if text2 is None:
-        text2 = text + ' complete'
-    print_step(text2.format(*args) + '.')
+        print_step(text + ' complete.')
+    else:
+        print_step(text2.format(*args) + '.')
 
 def format_bytes(bytes: int) -> str:
     if bytes >= 1024*1024*1024:
@@ -40,3 +49,28 @@ def run_visible(args: Sequence[Union[bytes, str]], **kwargs) -> CompletedProcess
     sys.stderr.flush()
     sys.stdout.flush()
     return run(args, **kwargs)
+
+def popen_visible(args: Sequence[Union[bytes, str]], **kwargs: Any) -> "Popen[bytes]":
+    sys.stderr.flush()
+    sys.stdout.flush()
+    return Popen(args, **kwargs)
+
+def spawn_visible(args: Sequence[str], check: bool=False) -> "CompletedProcess[bytes]":
+    """Like run_visible() for a child that simply inherits stdin, stdout
+    and stderr, but started with posix_spawn(3) where available, which
+    avoids subprocess's fork and error-pipe machinery.
+    """
+    if not hasattr(os, "posix_spawnp"):
+        return run_visible(args, check=check)
+
+    sys.stderr.flush()
+    sys.stdout.flush()
+    pid = os.posix_spawnp(args[0], list(args), os.environ)
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+        returncode = -os.WTERMSIG(status)
+    else:
+        returncode = os.WEXITSTATUS(status)
+    if check and returncode != 0:
+        raise CalledProcessError(returncode, args)
+    return CompletedProcess(args, returncode)
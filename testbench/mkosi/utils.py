@@ -1,73 +1,210 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import functools
 import os
 import os.path
+import re
 import shutil
+import socket
+import stat
+import urllib.error
 import urllib.request
 import uuid
-from typing import Callable, Dict, List
+from subprocess import CalledProcessError
+from typing import Callable, Dict, List, Match, Optional, Pattern, Tuple, Union
 
-from .btrfs import btrfs_subvol_delete
+from .btrfs import BTRFS_SUBVOL_INO, btrfs_subvol_delete
 from .types import CommandLineArguments
-from .ui import die, run_visible
+from .ui import die, run_visible, spawn_visible, warn
 
 
+MS_BIND    = 0x1000
+
+@functools.lru_cache(maxsize=None)
+def libc() -> ctypes.CDLL:
+    libc_name = ctypes.util.find_library("c")
+    if libc_name is None:
+        die("Could not find libc")
+    return ctypes.CDLL(libc_name, use_errno=True)
+
 def mount_bind(what: str, where: str) -> None:
     os.makedirs(what, 0o755, True)
     os.makedirs(where, 0o755, True)
-    run_visible(["mount", "--verbose", "--bind", what, where], check=True)
+    # Call mount(2) directly; forking mount(8) for every bind adds up
+    if libc().mount(os.fsencode(what), os.fsencode(where), None, ctypes.c_ulong(MS_BIND), None) != 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e), where)
+
+def _mounts_below(where: str) -> List[str]:
+    """The mount points at or below where, in the order they were mounted"""
+    where = os.path.realpath(where)
+    mounts = []
+    with open("/proc/self/mountinfo", "rb") as f:
+        for line in f:
+            # The mount point is the fifth field, with whitespace and
+            # backslashes octal-escaped
+            mountpoint = re.sub(rb"\\([0-7]{3})", lambda m: bytes([int(m.group(1), 8)]), line.split()[4])
+            path = os.fsdecode(mountpoint)
+            if path == where or path.startswith(where.rstrip("/") + "/"):
+                mounts.append(path)
+    return mounts
+
+def sys_umount(where: str, check: bool=True) -> None:
+    """Like umount(), unmounting where and everything mounted below it,
+    but with umount2(2) calls instead of forking umount(8).
+
+    Unlike umount(), failures other than where not being mounted raise
+    OSError.  With check=False they are only warned about, for cleaning
+    up after an error that shouldn't be masked by a busy mount.
+    """
+    for path in reversed(_mounts_below(where)):
+        if libc().umount2(os.fsencode(path), ctypes.c_int(0)) != 0:
+            e = ctypes.get_errno()
+            if e in {errno.EINVAL, errno.ENOENT}:
+                continue
+            if check:
+                raise OSError(e, os.strerror(e), path)
+            warn("Failed to unmount {}: {}", path, os.strerror(e))
 
 def umount(where: str) -> None:
     # Ignore failures
     run_visible(["umount", "--verbose", "--recursive", "-n", where])
 
-def patch_file(filepath: str, line_rewriter: Callable[[str], str]) -> None:
+def _write_all(fd: int, data: bytes) -> None:
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+def _link_tmpfile(data: bytes, directory: str, name: str) -> bool:
+    """Write data to an anonymous O_TMPFILE in directory and link it in as name
+
+    Returns False if the file system doesn't support O_TMPFILE.
+    """
+    if not hasattr(os, "O_TMPFILE"):
+        return False
+
+    dirfd = os.open(directory, os.O_RDONLY|os.O_DIRECTORY|os.O_CLOEXEC)
+    try:
+        try:
+            fd = os.open(".", os.O_TMPFILE|os.O_WRONLY|os.O_CLOEXEC, 0o600, dir_fd=dirfd)
+        except OSError as e:
+            if e.errno not in {errno.EOPNOTSUPP, errno.EISDIR, errno.EINVAL}:
+                raise
+            return False
+        try:
+            _write_all(fd, data)
+            try:
+                os.unlink(name, dir_fd=dirfd)
+            except FileNotFoundError:
+                pass
+            # Passing dst_dir_fd makes this linkat(AT_SYMLINK_FOLLOW)
+            os.link("/proc/self/fd/" + str(fd), name, dst_dir_fd=dirfd)
+        finally:
+            os.close(fd)
+    finally:
+        os.close(dirfd)
+    return True
+
+def _replace_file_contents(filepath: str, data: bytes) -> None:
     temp_new_filepath = filepath + ".tmp.new"
 
-    with open(filepath, "r") as old:
-        with open(temp_new_filepath, "w") as new:
-            for line in old:
-                new.write(line_rewriter(line))
+    # Only give the new file a name once it is complete, so that a crash
+    # never leaves a half-written .tmp.new behind. Start out private,
+    # copystat() below puts the real mode in place.
+    if not _link_tmpfile(data, os.path.dirname(filepath) or ".", os.path.basename(temp_new_filepath)):
+        fd = os.open(temp_new_filepath, os.O_WRONLY|os.O_CREAT|os.O_TRUNC|os.O_CLOEXEC, 0o600)
+        try:
+            _write_all(fd, data)
+        finally:
+            os.close(fd)
 
     shutil.copystat(filepath, temp_new_filepath)
-    os.remove(filepath)
-    shutil.move(temp_new_filepath, filepath)
-
-def run_workspace_command(args: CommandLineArguments, workspace: str, *cmd: str, network: bool=False, env: Dict[str, str]={}, nspawn_params: List[str]=[]) -> None:
-
-    cmdline = ["systemd-nspawn",
-               '--quiet',
-               "--directory=" + os.path.join(workspace, "root"),
-               "--uuid=" + args.machine_id,
-               "--machine=mkosi-" + uuid.uuid4().hex,
-               "--as-pid2",
-               "--register=no",
-               "--keep-unit",
-               "--bind=" + var_tmp(workspace) + ":/var/tmp",
-               "--setenv=SYSTEMD_OFFLINE=1" ]
-
-    if network:
-        # If we're using the host network namespace, use the same resolver
-        cmdline += ["--bind-ro=/etc/resolv.conf"]
-    else:
-        cmdline += ["--private-network"]
-
-    cmdline += [ "--setenv={}={}".format(k, v) for k, v in env.items() ]
+    os.replace(temp_new_filepath, filepath)
+
+def patch_file(filepath: str, line_rewriter: Callable[[str], str]) -> None:
+    # Read the whole file in one go and write the result in one go;
+    # these are small config files, so the per-line I/O dominates.
+    with open(filepath, "r", encoding="utf-8") as old:
+        lines = old.readlines()
+    _replace_file_contents(filepath, "".join(map(line_rewriter, lines)).encode("utf-8"))
+
+def patch_file_regex(filepath: str, pattern: Pattern[bytes], repl: Union[bytes, Callable[[Match[bytes]], bytes]], count: int=0) -> None:
+    """Like patch_file(), but substitutes pattern over the raw file contents at once
+
+    Use re.MULTILINE in pattern to anchor on line starts.
+    """
+    with open(filepath, "rb") as old:
+        data = old.read()
+    _replace_file_contents(filepath, pattern.sub(repl, data, count))
+
+@functools.lru_cache(maxsize=None)
+def nspawn_binary() -> str:
+    # Resolve once, so that each spawn doesn't have to search $PATH again
+    return shutil.which("systemd-nspawn") or "systemd-nspawn"
+
+@functools.lru_cache(maxsize=32)
+def _nspawn_prefix(machine_id: str, workspace: str, target: Optional[str], var_tmp_path: str) -> Tuple[str, ...]:
+    if target is None:
+        target = "--directory=" + os.path.join(workspace, "root")
+
+    return (nspawn_binary(),
+            '--quiet',
+            target,
+            "--uuid=" + machine_id,
+            "--as-pid2",
+            "--register=no",
+            "--bind=" + var_tmp_path + ":/var/tmp")
+
+_WORKSPACE_COMMAND_PARAMS = ("--keep-unit",
+                             "--setenv=SYSTEMD_OFFLINE=1")
+
+def nspawn_cmdline(args: CommandLineArguments, workspace: str, target: Optional[str]=None, network: bool=False, env: Optional[Dict[str, str]]=None) -> List[str]:
+    """Return the systemd-nspawn options shared by all containers of a build
+
+    target defaults to --directory= on the workspace root. Callers append
+    their own options, then the command.
+    """
+    # The machine name must be fresh for every container, so it is the
+    # only part of the common prefix that is not cached.
+    cmdline = list(_nspawn_prefix(args.machine_id, workspace, target, var_tmp(workspace)))
+    cmdline += ["--machine=mkosi-" + uuid.uuid4().hex,
+                # If we're using the host network namespace, use the same resolver
+                "--bind-ro=/etc/resolv.conf" if network else "--private-network"]
+
+    if env:
+        cmdline.extend("--setenv=" + k + "=" + v for k, v in env.items())
+
+    return cmdline
+
+def run_workspace_command(args: CommandLineArguments, workspace: str, *cmd: str, network: bool=False, env: Optional[Dict[str, str]]=None, nspawn_params: Optional[List[str]]=None) -> None:
+    cmdline = nspawn_cmdline(args, workspace, network=network, env=env)
+    cmdline.extend(_WORKSPACE_COMMAND_PARAMS)
 
     if nspawn_params:
-        cmdline += nspawn_params
+        cmdline.extend(nspawn_params)
 
-    cmdline += ['--', *cmd]
-    run_visible(cmdline, check=True)
+    cmdline.append('--')
+    cmdline.extend(cmd)
+    spawn_visible(cmdline, check=True)
 
 def check_if_url_exists(url: str) -> bool:
     req = urllib.request.Request(url, method="HEAD")
     try:
-        if urllib.request.urlopen(req):
+        with urllib.request.urlopen(req, timeout=5):
             return True
+    except (urllib.error.URLError, socket.timeout, ConnectionError):
         return False
-    except:
-        return False
+
+def check_urls_exist(urls: List[str]) -> Dict[str, bool]:
+    """Probe several URLs concurrently, so that their round trips overlap."""
+    if not urls:
+        return {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(urls), 16)) as executor:
+        return dict(zip(urls, executor.map(check_if_url_exists, urls)))
 
 def mkdir_last(path: str, mode: int=0o777) -> str:
     """Create directory path
@@ -77,37 +214,68 @@ def mkdir_last(path: str, mode: int=0o777) -> str:
     try:
         os.mkdir(path, mode)
     except FileExistsError:
-        if not os.path.isdir(path):
+        # Follow symlinks, a symlinked output directory is fine
+        if not stat.S_ISDIR(os.stat(path).st_mode):
             raise
     return path
 
+_var_tmp_cache: Dict[str, str] = {}
+
 def var_tmp(workspace: str) -> str:
-    return mkdir_last(os.path.join(workspace, "var-tmp"))
+    # Every nspawn invocation asks for this, so only create it once per
+    # workspace; remove_var_tmp() forgets it again.
+    path = _var_tmp_cache.get(workspace)
+    if path is None:
+        path = _var_tmp_cache[workspace] = mkdir_last(os.path.join(workspace, "var-tmp"))
+    return path
 
-def unlink_try_hard(path: str) -> None:
-    try:
-        os.unlink(path)
-    except:
-        pass
+def remove_var_tmp(workspace: str) -> None:
+    _var_tmp_cache.pop(workspace, None)
+    unlink_try_hard(os.path.join(workspace, "var-tmp"))
 
-    try:
-        btrfs_subvol_delete(path)
-    except:
-        pass
+def _remove_stat(path: str, st: os.stat_result) -> None:
+    """Remove path, picking the method from its (lstat) metadata"""
+    if not stat.S_ISDIR(st.st_mode):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return
 
+    if st.st_ino == BTRFS_SUBVOL_INO:
+        try:
+            btrfs_subvol_delete(path)
+            return
+        except (OSError, CalledProcessError):
+            pass
+
+    shutil.rmtree(path, ignore_errors=True)
+
+def unlink_try_hard(path: str) -> None:
     try:
-        shutil.rmtree(path)
-    except:
-        pass
+        st = os.lstat(path)
+    except OSError:
+        return
+    _remove_stat(path, st)
 
 def empty_directory(path: str) -> None:
 
     try:
-        for f in os.listdir(path):
-            unlink_try_hard(os.path.join(path, f))
+        with os.scandir(path) as it:
+            entries = list(it)
     except FileNotFoundError:
-        pass
+        return
+
+    for entry in entries:
+        try:
+            st = entry.stat(follow_symlinks=False)
+        except FileNotFoundError:
+            continue
+        _remove_stat(entry.path, st)
+
+# Nothing in here changes credentials, so look them up only once
+IS_ROOT = os.geteuid() == 0
 
 def check_root() -> None:
-    if os.getuid() != 0:
+    if not IS_ROOT:
         die("Must be invoked as root.")
@@ -1,23 +1,33 @@
 # SPDX-License-Identifier: LGPL-2.1+
 
+import concurrent.futures
 import contextlib
 import crypt
 import ctypes
-import ctypes.util
 import errno
 import fcntl
+import functools
 import hashlib
+import mmap
 import os
+import re
 import shutil
 import stat
+import struct
 import tempfile
 import uuid
-from subprocess import DEVNULL, PIPE, run
-from typing import BinaryIO, Dict, Iterator, Optional, TextIO, Tuple, cast
+from subprocess import PIPE, CalledProcessError
+from typing import BinaryIO, Callable, Dict, Iterator, List, Optional, TextIO, Tuple, cast
 
 from . import summary
 from .. import distros
-from ..btrfs import btrfs_subvol_create, btrfs_subvol_make_ro
+from ..btrfs import (
+    BTRFS_SUBVOL_INO,
+    btrfs_subvol_create,
+    btrfs_subvol_create_batch,
+    btrfs_subvol_make_ro,
+    btrfs_subvol_snapshot,
+)
 from ..docker import run_in_docker
 from ..gpt import (
     GPT_ESP,
@@ -46,16 +56,20 @@ from ..types import (
     CommandLineArguments,
     OutputFormat,
 )
-from ..ui import complete_step, die, format_bytes, print_step, run_visible
+from ..ui import complete_step, die, format_bytes, popen_visible, print_step, run_visible, spawn_visible
 from ..utils import (
+    libc,
     mkdir_last,
     mount_bind,
-    patch_file,
+    nspawn_cmdline,
+    patch_file_regex,
+    remove_var_tmp,
     run_workspace_command,
+    sys_umount,
     umount,
     unlink_try_hard,
-    var_tmp,
 )
+from ..verity import verity_format
 
 NEEDS_ROOT = False
 NEEDS_BUILD = False
@@ -65,69 +79,82 @@ FORCE_UNLINKS = True
 CLONE_NEWNS = 0x00020000
 
 def unshare(flags: int) -> None:
-    libc_name = ctypes.util.find_library("c")
-    if libc_name is None:
-        die("Could not find libc")
-    libc = ctypes.CDLL(libc_name, use_errno=True)
-
-    if libc.unshare(ctypes.c_int(flags)) != 0:
+    if libc().unshare(ctypes.c_int(flags)) != 0:
         e = ctypes.get_errno()
         raise OSError(e, os.strerror(e))
 
 def roundup512(x: int) -> int:
     return (x + 511) & ~511
 
-_IOC_NRBITS   = 8
-_IOC_TYPEBITS = 8
-_IOC_SIZEBITS = 14
-_IOC_DIRBITS  = 2
-
-_IOC_NRSHIFT   = 0
-_IOC_TYPESHIFT = _IOC_NRSHIFT + _IOC_NRBITS
-_IOC_SIZESHIFT = _IOC_TYPESHIFT + _IOC_TYPEBITS
-_IOC_DIRSHIFT  = _IOC_SIZESHIFT + _IOC_SIZEBITS
-
-_IOC_NONE  = 0
-_IOC_WRITE = 1
-_IOC_READ  = 2
-
-def _IOC(dir: int, type: int, nr: int, argtype: str) -> int:
-    size = {'int': 4, 'size_t': 8}[argtype]
-    return dir<<_IOC_DIRSHIFT | type<<_IOC_TYPESHIFT | nr<<_IOC_NRSHIFT | size<<_IOC_SIZESHIFT
-
-
-def _IOW(type: int, nr: int, size: str) -> int:
-    return _IOC(_IOC_WRITE, type, nr, size)
-
-FICLONE = _IOW(0x94, 9, 'int')
+# _IOW(0x94, 9, int), the same constant as BTRFS_IOC_CLONE
+FICLONE = 0x40049409
+# _IOR('f', 1, long) and _IOW('f', 2, long), even though the kernel only
+# ever transfers an int
+FS_IOC_GETFLAGS = 0x80086601
+FS_IOC_SETFLAGS = 0x40086602
+FS_NOCOW_FL = 0x00800000
+FS_IOC_FLAGS = struct.Struct("i")
 
 @contextlib.contextmanager
-def open_close(path: str, flags: int, mode: int=0o664) -> Iterator[int]:
-    fd = os.open(path, flags | os.O_CLOEXEC, mode)
+def open_close(path: str, flags: int, mode: int=0o664, dir_fd: Optional[int]=None) -> Iterator[int]:
+    fd = os.open(path, flags | os.O_CLOEXEC, mode, dir_fd=dir_fd)
     try:
         yield fd
     finally:
         os.close(fd)
 
+def dir_fd_opener(dir_fd: int) -> Callable[[str, int], int]:
+    """An opener for open() that resolves relative paths against dir_fd"""
+    return lambda path, flags: os.open(path, flags | os.O_CLOEXEC, 0o666, dir_fd=dir_fd)
+
 def _reflink(oldfd: int, newfd: int) -> None:
     fcntl.ioctl(newfd, FICLONE, oldfd)
 
+def _copy_file_range(oldfd: int, newfd: int) -> bool:
+    """Copy the rest of oldfd to newfd without going through userspace
+
+    Returns False if the kernel or filesystem can't do it, in which case
+    the caller should continue from the current file offsets.
+    """
+    if not hasattr(os, "copy_file_range"):
+        return False
+    try:
+        while os.copy_file_range(oldfd, newfd, 1 << 30):
+            pass
+    except OSError as e:
+        if e.errno not in {errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP}:
+            raise
+        return False
+    return True
+
+def _sendfile(oldfd: int, newfd: int) -> bool:
+    """Like _copy_file_range(), but with sendfile(2), which works across
+    filesystems on any kernel we care about"""
+    if not stat.S_ISREG(os.fstat(oldfd).st_mode):
+        return False
+    try:
+        while os.sendfile(newfd, oldfd, None, 1 << 30):
+            pass
+    except OSError as e:
+        if e.errno not in {errno.ENOSYS, errno.EINVAL}:
+            raise
+        return False
+    return True
+
 def copy_fd(oldfd: int, newfd: int) -> None:
     try:
         _reflink(oldfd, newfd)
     except OSError as e:
         if e.errno not in {errno.EXDEV, errno.EOPNOTSUPP}:
             raise
+        if _copy_file_range(oldfd, newfd) or _sendfile(oldfd, newfd):
+            return
         shutil.copyfileobj(open(oldfd, 'rb', closefd=False),
                            open(newfd, 'wb', closefd=False))
 
 def copy_file_object(oldobject: BinaryIO, newobject: BinaryIO) -> None:
-    try:
-        _reflink(oldobject.fileno(), newobject.fileno())
-    except OSError as e:
-        if e.errno not in {errno.EXDEV, errno.EOPNOTSUPP}:
-            raise
-        shutil.copyfileobj(oldobject, newobject)
+    newobject.flush()
+    copy_fd(oldobject.fileno(), newobject.fileno())
 
 def copy_symlink(oldpath: str, newpath: str) -> None:
     src = os.readlink(oldpath)
@@ -139,16 +166,38 @@ def copy_file(oldpath: str, newpath: str) -> None:
         return
 
     with open_close(oldpath, os.O_RDONLY) as oldfd:
-        st = os.stat(oldfd)
+        _copy_regular(oldfd, newpath, os.stat(oldfd))
+
+def _copystat_fd(oldfd: int, newfd: int, st: os.stat_result) -> None:
+    """Like shutil.copystat(), but on open files and with a known stat result"""
+    os.utime(newfd, ns=(st.st_atime_ns, st.st_mtime_ns))
 
+    # Most files have no xattrs at all, so only a single listxattr()
+    try:
+        names = os.listxattr(oldfd)
+    except OSError as e:
+        if e.errno not in {errno.ENOTSUP, errno.ENODATA, errno.EINVAL}:
+            raise
+        names = []
+    for name in names:
         try:
-            with open_close(newpath, os.O_WRONLY|os.O_CREAT|os.O_EXCL, st.st_mode) as newfd:
-                copy_fd(oldfd, newfd)
-        except FileExistsError:
-            os.unlink(newpath)
-            with open_close(newpath, os.O_WRONLY|os.O_CREAT, st.st_mode) as newfd:
-                copy_fd(oldfd, newfd)
-    shutil.copystat(oldpath, newpath, follow_symlinks=False)
+            os.setxattr(newfd, name, os.getxattr(oldfd, name))
+        except OSError as e:
+            if e.errno not in {errno.EPERM, errno.ENOTSUP, errno.ENODATA, errno.EINVAL}:
+                raise
+
+    os.chmod(newfd, stat.S_IMODE(st.st_mode))
+
+def _copy_regular(oldfd: int, newpath: str, st: os.stat_result) -> None:
+    try:
+        with open_close(newpath, os.O_WRONLY|os.O_CREAT|os.O_EXCL, st.st_mode) as newfd:
+            copy_fd(oldfd, newfd)
+            _copystat_fd(oldfd, newfd, st)
+    except FileExistsError:
+        os.unlink(newpath)
+        with open_close(newpath, os.O_WRONLY|os.O_CREAT, st.st_mode) as newfd:
+            copy_fd(oldfd, newfd)
+            _copystat_fd(oldfd, newfd, st)
 
 def symlink_f(target: str, path: str) -> None:
     try:
@@ -157,7 +206,36 @@ def symlink_f(target: str, path: str) -> None:
         os.unlink(path)
         os.symlink(target, path)
 
+def _copy_nested_subvolumes(oldpath: str, newpath: str) -> None:
+    """Fill in the placeholders a snapshot of oldpath left for its nested subvolumes"""
+    with os.scandir(oldpath) as it:
+        dirs = [entry for entry in it if entry.is_dir(follow_symlinks=False)]
+    for entry in dirs:
+        newentry = os.path.join(newpath, entry.name)
+        if entry.stat(follow_symlinks=False).st_ino == BTRFS_SUBVOL_INO:  # type: ignore # mypy 0.641 doesn't know about follow_symlinks
+            os.rmdir(newentry)
+            copy(entry.path, newentry)
+        else:
+            _copy_nested_subvolumes(entry.path, newentry)
+
+def _snapshot_tree(oldpath: str, newpath: str) -> bool:
+    """Copy a btrfs subvolume by snapshotting it, if possible"""
+    if os.lstat(oldpath).st_ino != BTRFS_SUBVOL_INO:
+        return False
+    try:
+        btrfs_subvol_snapshot(oldpath, newpath)
+    except OSError:
+        # Not btrfs, a different filesystem, or not permitted
+        return False
+    _copy_nested_subvolumes(oldpath, newpath)
+    return True
+
 def copy(oldpath: str, newpath: str) -> None:
+    # A snapshot shares all extents with the source, but can only create
+    # newpath, not merge into a directory that is already there.
+    if not os.path.lexists(newpath) and _snapshot_tree(oldpath, newpath):
+        return
+
     try:
         mkdir_last(newpath)
     except FileExistsError:
@@ -165,21 +243,36 @@ def copy(oldpath: str, newpath: str) -> None:
         os.unlink(newpath)
         mkdir_last(newpath)
 
-    for entry in os.scandir(oldpath):
-        newentry = os.path.join(newpath, entry.name)
-        if entry.is_dir(follow_symlinks=False):
-            copy(entry.path, newentry)
-        elif entry.is_symlink():
-            target = os.readlink(entry.path)
-            symlink_f(target, newentry)
-            shutil.copystat(entry.path, newentry, follow_symlinks=False)
-        else:
-            st = entry.stat(follow_symlinks=False)  # type: ignore # mypy 0.641 doesn't know about follow_symlinks
-            if stat.S_ISREG(st.st_mode):
-                copy_file(entry.path, newentry)
+    # Sort the entries by the type scandir() already got from the kernel,
+    # so that nothing needs to be stat()ed just to classify it.
+    dirs = []
+    symlinks = []
+    regulars = []
+    with os.scandir(oldpath) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                dirs.append(entry)
+            elif entry.is_symlink():
+                symlinks.append(entry)
+            elif entry.is_file(follow_symlinks=False):
+                regulars.append(entry)
             else:
                 print('Ignoring', entry.path)
-                continue
+
+    for entry in regulars:
+        st = entry.stat(follow_symlinks=False)  # type: ignore # mypy 0.641 doesn't know about follow_symlinks
+        with open_close(entry.path, os.O_RDONLY|os.O_NOFOLLOW) as oldfd:
+            _copy_regular(oldfd, os.path.join(newpath, entry.name), st)
+
+    for entry in symlinks:
+        newentry = os.path.join(newpath, entry.name)
+        symlink_f(os.readlink(entry.path), newentry)
+        shutil.copystat(entry.path, newentry, follow_symlinks=False)
+
+    # Recurse last, while this directory's inodes are still cached
+    for entry in dirs:
+        copy(entry.path, os.path.join(newpath, entry.name))
+
     shutil.copystat(oldpath, newpath, follow_symlinks=True)
 
 # Kinda like Bash <<-'EOT' here-docs
@@ -250,7 +343,7 @@ def setup_workspace(args: CommandLineArguments) -> Iterator[str]:
     with complete_step('Setting up temporary workspace',
                        'Setting up temporary workspace {} complete') as output:
         if args.output_format in (OutputFormat.directory, OutputFormat.subvolume):
-            d = tempfile.TemporaryDirectory(dir=os.path.dirname(args.output), prefix='.mkosi-')
+            d = tempfile.TemporaryDirectory(dir=args.output_dirname, prefix='.mkosi-')
         else:
             d = tempfile.TemporaryDirectory(dir='/var/tmp', prefix='mkosi-')
             output.append(d.name)
@@ -282,7 +375,16 @@ def image_size(args: CommandLineArguments) -> int:
 def disable_cow(path: str) -> None:
     """Disable copy-on-write if applicable on filesystem"""
 
-    run(["chattr", "+C", path], stdout=DEVNULL, stderr=DEVNULL, check=False)
+    # This is what chattr +C does, minus the fork. Filesystems without
+    # the flag reject the ioctl, which is fine.
+    with open_close(path, os.O_RDONLY|os.O_NOFOLLOW) as fd:
+        buf = bytearray(FS_IOC_FLAGS.size)
+        try:
+            fcntl.ioctl(fd, FS_IOC_GETFLAGS, buf)
+            flags, = FS_IOC_FLAGS.unpack(buf)
+            fcntl.ioctl(fd, FS_IOC_SETFLAGS, FS_IOC_FLAGS.pack(flags | FS_NOCOW_FL))
+        except OSError:
+            pass
 
 def determine_partition_table(args: CommandLineArguments) -> Tuple[Dict[int, Partition], bool]:
 
@@ -315,7 +417,7 @@ def determine_partition_table(args: CommandLineArguments) -> Tuple[Dict[int, Par
     args.home_partno = None
     args.srv_partno = None
 
-    if args.output_format != OutputFormat.raw_btrfs:
+    if args.output_format is not OutputFormat.raw_btrfs:
         if args.home_size is not None:
             table[pn] = Partition(
                 p_size=args.home_size // 512,
@@ -334,10 +436,10 @@ def determine_partition_table(args: CommandLineArguments) -> Tuple[Dict[int, Par
             pn += 1
             run_sfdisk = True
 
-    if args.output_format != OutputFormat.raw_squashfs:
+    if args.output_format is not OutputFormat.raw_squashfs:
         table[pn] = Partition(
             p_type=gpt_root_native().root,
-            p_attrs="GUID:60" if args.read_only and args.output_format != OutputFormat.raw_btrfs else None,
+            p_attrs="GUID:60" if args.read_only and args.output_format is not OutputFormat.raw_btrfs else None,
             p_name="Root Partition")
         run_sfdisk = True
 
@@ -353,6 +455,27 @@ def determine_partition_table(args: CommandLineArguments) -> Tuple[Dict[int, Par
     return table, run_sfdisk
 
 
+def resize_file(fd: int, size: int) -> None:
+    """Resize a file, reserving the space it grows by as unwritten extents
+
+    That way populating the image doesn't allocate block by block. If the
+    file system can't do that (or is too full), fall back to a sparse
+    file.
+    """
+    old_size = os.fstat(fd).st_size
+    if size > old_size:
+        # fallocate(2) itself rather than posix_fallocate(), which glibc
+        # emulates by writing to every block where fallocate(2) isn't
+        # supported; that would turn a sparse image into a slow, fully
+        # written one.
+        try:
+            fallocate = libc().fallocate64
+        except AttributeError:
+            fallocate = libc().fallocate
+        if fallocate(fd, ctypes.c_int(0), ctypes.c_int64(old_size), ctypes.c_int64(size - old_size)) == 0:
+            return
+    os.ftruncate(fd, size)
+
 def create_image(args: CommandLineArguments, workspace: str, for_cache: bool) -> Optional[BinaryIO]:
     if args.output_format not in RAW_FORMATS:
         return None
@@ -360,10 +483,12 @@ def create_image(args: CommandLineArguments, workspace: str, for_cache: bool) ->
     with complete_step('Creating partition table',
                        'Created partition table as {.name}') as output:
 
-        f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(dir=os.path.dirname(args.output), prefix='.mkosi-', delete=not for_cache))
+        f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(dir=args.output_dirname, prefix='.mkosi-', delete=not for_cache))
         output.append(f)
         disable_cow(f.name)
-        f.truncate(image_size(args))
+        size = image_size(args)
+        # This has to come after disable_cow().
+        resize_file(f.fileno(), size)
 
         table, run_sfdisk = determine_partition_table(args)
 
@@ -401,7 +526,7 @@ def reuse_cache_image(args: CommandLineArguments, workspace: str, run_build_scri
             return None, False
 
         with source:
-            f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(dir=os.path.dirname(args.output), prefix='.mkosi-'))
+            f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(dir=args.output_dirname, prefix='.mkosi-'))
             output.append(f)
 
             # So on one hand we want CoW off, since this stuff will
@@ -474,15 +599,15 @@ def mkfs_xfs(label: str, dev: str) -> None:
 def prepare_root(args: CommandLineArguments, dev: Optional[str], cached: bool) -> None:
     if dev is None:
         return
-    if args.output_format == OutputFormat.raw_squashfs:
+    if args.output_format is OutputFormat.raw_squashfs:
         return
     if cached:
         return
 
     with complete_step('Formatting root partition'):
-        if args.output_format == OutputFormat.raw_btrfs:
+        if args.output_format is OutputFormat.raw_btrfs:
             mkfs_btrfs("root", dev)
-        elif args.output_format == OutputFormat.raw_xfs:
+        elif args.output_format is OutputFormat.raw_xfs:
             mkfs_xfs("root", dev)
         else:
             mkfs_ext4("root", "/", dev)
@@ -505,12 +630,21 @@ def prepare_srv(args: CommandLineArguments, dev: Optional[str], cached: bool) ->
     with complete_step('Formatting server data partition'):
         mkfs_ext4("srv", "/srv", dev)
 
+def prepare_partitions(args: CommandLineArguments, loopdev: Optional[str], root: Optional[str], home: Optional[str], srv: Optional[str], cached: bool) -> None:
+    # One after another, so that each step's messages and mkfs's own
+    # output don't interleave with the others'
+    prepare_swap(args, loopdev, cached)
+    prepare_esp(args, loopdev, cached)
+    prepare_root(args, root, cached)
+    prepare_home(args, home, cached)
+    prepare_srv(args, srv, cached)
+
 def mount_loop(args: CommandLineArguments, dev: str, where: str, read_only: bool=False) -> None:
     os.makedirs(where, 0o755, True)
 
     options = "-odiscard"
 
-    if args.compress and args.output_format == OutputFormat.raw_btrfs:
+    if args.compress and args.output_format is OutputFormat.raw_btrfs:
         options += ",compress"
 
     if read_only:
@@ -531,7 +665,7 @@ def mount_image(args: CommandLineArguments, workspace: str, loopdev: Optional[st
     root = os.path.join(workspace, "root")
     with complete_step('Mounting image at {}'.format(root)):
 
-        if args.output_format != OutputFormat.raw_squashfs:
+        if args.output_format is not OutputFormat.raw_squashfs:
             mount_loop(args, root_dev, root, root_read_only)
 
         if home_dev is not None:
@@ -555,19 +689,19 @@ def mount_image(args: CommandLineArguments, workspace: str, loopdev: Optional[st
 
 @complete_step("Assigning hostname")
 def install_etc_hostname(args: CommandLineArguments, workspace: str) -> None:
-    etc_hostname = os.path.join(workspace, "root", "etc/hostname")
-
-    # Always unlink first, so that we don't get in trouble due to a
-    # symlink or suchlike. Also if no hostname is configured we really
-    # don't want the file to exist, so that systemd's implicit
-    # hostname logic can take effect.
-    try:
-        os.unlink(etc_hostname)
-    except FileNotFoundError:
-        pass
+    with open_close(os.path.join(workspace, "root", "etc"), os.O_RDONLY|os.O_DIRECTORY) as etcfd:
+        # Always unlink first, so that we don't get in trouble due to a
+        # symlink or suchlike. Also if no hostname is configured we really
+        # don't want the file to exist, so that systemd's implicit
+        # hostname logic can take effect.
+        try:
+            os.unlink("hostname", dir_fd=etcfd)
+        except FileNotFoundError:
+            pass
 
-    if args.hostname:
-        open(etc_hostname, "w").write(args.hostname + "\n")
+        if args.hostname:
+            with open("hostname", "w", opener=dir_fd_opener(etcfd)) as f:
+                f.write(args.hostname + "\n")
 
 @contextlib.contextmanager
 def mount_cache(args: CommandLineArguments, workspace: str) -> Iterator[None]:
@@ -578,6 +712,7 @@ def mount_cache(args: CommandLineArguments, workspace: str) -> Iterator[None]:
 
     # We can't do this in mount_image() yet, as /var itself might have to be created as a subvolume first
     mountpoints = []
+    succeeded = False
     try:
         cachedirs = distros.get_distro(args.distribution).PKG_CACHE
         with complete_step('Mounting Package Cache {}'.format(cachedirs)):
@@ -593,66 +728,73 @@ def mount_cache(args: CommandLineArguments, workspace: str) -> Iterator[None]:
                                mountpoint)
                     mountpoints.append(mountpoint)
             yield
+            succeeded = True
     finally:
+        # Don't let a mount left busy by a failure replace its error
         with complete_step('Unmounting Package Cache {}'.format(cachedirs)):
             for d in mountpoints:
-                umount(os.path.join(workspace, "root", d))
+                sys_umount(d, check=succeeded)
 
 @complete_step('Setting up basic OS tree')
 def prepare_tree(args: CommandLineArguments, workspace: str, run_build_script: bool, cached: bool) -> None:
+    root = os.path.join(workspace, "root")
 
-    if args.output_format == OutputFormat.subvolume:
-        btrfs_subvol_create(os.path.join(workspace, "root"))
+    if args.output_format is OutputFormat.subvolume:
+        btrfs_subvol_create(root)
     else:
-        mkdir_last(os.path.join(workspace, "root"))
+        mkdir_last(root)
+
+    # Everything below is created relative to the root directory, so the
+    # kernel doesn't have to walk the workspace path for every entry.
+    with open_close(root, os.O_RDONLY|os.O_DIRECTORY) as rootfd:
+        if args.output_format in (OutputFormat.subvolume, OutputFormat.raw_btrfs):
 
-    if args.output_format in (OutputFormat.subvolume, OutputFormat.raw_btrfs):
+            if cached and args.output_format is OutputFormat.raw_btrfs:
+                return
 
-        if cached and args.output_format is OutputFormat.raw_btrfs:
+            btrfs_subvol_create_batch(rootfd, [("home", 0o755),
+                                               ("srv", 0o755),
+                                               ("var", 0o755),
+                                               ("var/tmp", 0o1777)])
+            os.mkdir("var/lib", dir_fd=rootfd)
+            btrfs_subvol_create_batch(rootfd, [("var/lib/machines", 0o700)])
+
+        if cached:
             return
 
-        btrfs_subvol_create(os.path.join(workspace, "root", "home"))
-        btrfs_subvol_create(os.path.join(workspace, "root", "srv"))
-        btrfs_subvol_create(os.path.join(workspace, "root", "var"))
-        btrfs_subvol_create(os.path.join(workspace, "root", "var/tmp"), 0o1777)
-        os.mkdir(os.path.join(workspace, "root", "var/lib"))
-        btrfs_subvol_create(os.path.join(workspace, "root", "var/lib/machines"), 0o700)
+        if args.bootable:
+            # We need an initialized machine ID for the boot logic to work
+            os.mkdir("etc", 0o755, dir_fd=rootfd)
+            with open("etc/machine-id", "w", opener=dir_fd_opener(rootfd)) as f:
+                f.write(args.machine_id)
+                f.write("\n")
 
-    if cached:
-        return
+            for d in ("efi/EFI",
+                      "efi/EFI/BOOT",
+                      "efi/EFI/Linux",
+                      "efi/EFI/systemd",
+                      "efi/loader",
+                      "efi/loader/entries",
+                      "efi/" + args.machine_id,
+                      "boot"):
+                os.mkdir(d, 0o700, dir_fd=rootfd)
 
-    if args.bootable:
-        # We need an initialized machine ID for the boot logic to work
-        os.mkdir(os.path.join(workspace, "root", "etc"), 0o755)
-        with open(os.path.join(workspace, "root", "etc/machine-id"), "w") as f:
-            f.write(args.machine_id)
-            f.write("\n")
-
-        os.mkdir(os.path.join(workspace, "root", "efi/EFI"), 0o700)
-        os.mkdir(os.path.join(workspace, "root", "efi/EFI/BOOT"), 0o700)
-        os.mkdir(os.path.join(workspace, "root", "efi/EFI/Linux"), 0o700)
-        os.mkdir(os.path.join(workspace, "root", "efi/EFI/systemd"), 0o700)
-        os.mkdir(os.path.join(workspace, "root", "efi/loader"), 0o700)
-        os.mkdir(os.path.join(workspace, "root", "efi/loader/entries"), 0o700)
-        os.mkdir(os.path.join(workspace, "root", "efi", args.machine_id), 0o700)
-
-        os.mkdir(os.path.join(workspace, "root", "boot"), 0o700)
-        os.symlink("../efi", os.path.join(workspace, "root", "boot/efi"))
-        os.symlink("efi/loader", os.path.join(workspace, "root", "boot/loader"))
-        os.symlink("efi/" + args.machine_id, os.path.join(workspace, "root", "boot", args.machine_id))
-
-        os.mkdir(os.path.join(workspace, "root", "etc/kernel"), 0o755)
-
-        with open(os.path.join(workspace, "root", "etc/kernel/cmdline"), "w") as cmdline:
-            cmdline.write(args.kernel_commandline)
-            cmdline.write("\n")
+            os.symlink("../efi", "boot/efi", dir_fd=rootfd)
+            os.symlink("efi/loader", "boot/loader", dir_fd=rootfd)
+            os.symlink("efi/" + args.machine_id, "boot/" + args.machine_id, dir_fd=rootfd)
 
-    if run_build_script:
-        os.mkdir(os.path.join(workspace, "root", "root"), 0o750)
-        os.mkdir(os.path.join(workspace, "root", "root/dest"), 0o755)
+            os.mkdir("etc/kernel", 0o755, dir_fd=rootfd)
 
-        if args.build_dir is not None:
-            os.mkdir(os.path.join(workspace, "root", "root/build"), 0o755)
+            with open("etc/kernel/cmdline", "w", opener=dir_fd_opener(rootfd)) as cmdline:
+                cmdline.write(args.kernel_commandline)
+                cmdline.write("\n")
+
+        if run_build_script:
+            os.mkdir("root", 0o750, dir_fd=rootfd)
+            os.mkdir("root/dest", 0o755, dir_fd=rootfd)
+
+            if args.build_dir is not None:
+                os.mkdir("root/build", 0o755, dir_fd=rootfd)
 
 def install_distribution(args: CommandLineArguments, workspace: str, run_build_script: bool, cached: bool) -> None:
 
@@ -699,6 +841,9 @@ def reset_random_seed(workspace: str) -> None:
         except FileNotFoundError:
             pass
 
+# The user name and password field of root's entry in passwd/shadow
+ROOT_PASSWORD_FIELD = re.compile(rb'^root:[^:\n]*', re.MULTILINE)
+
 def set_root_password(args: CommandLineArguments, workspace: str, run_build_script: bool, for_cache: bool) -> None:
     "Set the root account password, or just delete it so it's easy to log in"
 
@@ -709,24 +854,12 @@ def set_root_password(args: CommandLineArguments, workspace: str, run_build_scri
 
     if args.password == '':
         with complete_step("Deleting root password"):
-            def jj(line: str) -> str:
-                if line.startswith('root:'):
-                    return ':'.join(['root', ''] + line.split(':')[2:])
-                else:
-                    return line
-
-            patch_file(os.path.join(workspace, 'root', 'etc/passwd'), jj)
+            patch_file_regex(os.path.join(workspace, 'root', 'etc/passwd'), ROOT_PASSWORD_FIELD, b'root:', count=1)
     elif args.password:
         with complete_step("Setting root password"):
-            password = crypt.crypt(args.password, crypt.mksalt(crypt.METHOD_SHA512))
-
-            def jj(line: str) -> str:
-                if line.startswith('root:'):
-                    return ':'.join(['root', password] + line.split(':')[2:])
-                else:
-                    return line
-
-            patch_file(os.path.join(workspace, 'root', 'etc/shadow'), jj)
+            field = b'root:' + crypt.crypt(args.password, crypt.mksalt(crypt.METHOD_SHA512)).encode()
+            patch_file_regex(os.path.join(workspace, 'root', 'etc/shadow'), ROOT_PASSWORD_FIELD,
+                             lambda m: field, count=1)
 
 def run_postinst_script(args: CommandLineArguments, workspace: str, run_build_script: bool, for_cache: bool) -> None:
 
@@ -756,14 +889,30 @@ def install_boot_loader(args: CommandLineArguments, workspace: str, loopdev: Opt
         return
 
     with complete_step("Installing boot loader"):
-        shutil.copyfile(os.path.join(workspace, "root", "usr/lib/systemd/boot/efi/systemd-bootx64.efi"),
-                        os.path.join(workspace, "root", "boot/efi/EFI/systemd/systemd-bootx64.efi"))
-
-        shutil.copyfile(os.path.join(workspace, "root", "usr/lib/systemd/boot/efi/systemd-bootx64.efi"),
-                        os.path.join(workspace, "root", "boot/efi/EFI/BOOT/bootx64.efi"))
+        with open_close(os.path.join(workspace, "root"), os.O_RDONLY|os.O_DIRECTORY) as rootfd, \
+             open_close("usr/lib/systemd/boot/efi/systemd-bootx64.efi", os.O_RDONLY, dir_fd=rootfd) as oldfd:
+            for dest in ("boot/efi/EFI/systemd/systemd-bootx64.efi",
+                         "boot/efi/EFI/BOOT/bootx64.efi"):
+                os.lseek(oldfd, 0, os.SEEK_SET)
+                with open_close(dest, os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o666, dir_fd=rootfd) as newfd:
+                    copy_fd(oldfd, newfd)
 
         distros.get_distro(args.distribution).install_boot_loader(args, workspace, loopdev)
 
+def _install_trees(trees: List[str], root: str) -> None:
+    # Later trees override files from earlier ones, so they have to be
+    # applied one after the other.
+    for d in trees:
+        if os.path.isdir(d):
+            copy(d, root)
+        elif d.endswith(".zip"):
+            shutil.unpack_archive(d, root)
+        else:
+            # tar(1) decompresses natively, which is a lot faster than
+            # shutil.unpack_archive()'s pure-Python tarfile.
+            run_visible(["tar", "-C", root, "-x", "--xattrs", "--xattrs-include=*", "-f", d],
+                        check=True)
+
 def install_extra_trees(args: CommandLineArguments, workspace: str, for_cache: bool) -> None:
     if not args.extra_trees:
         return
@@ -772,63 +921,97 @@ def install_extra_trees(args: CommandLineArguments, workspace: str, for_cache: b
         return
 
     with complete_step('Copying in extra file trees'):
-        for d in args.extra_trees:
-            if os.path.isdir(d):
-                copy(d, os.path.join(workspace, "root"))
-            else:
-                shutil.unpack_archive(d, os.path.join(workspace, "root"))
+        _install_trees(args.extra_trees, os.path.join(workspace, "root"))
 
 def install_skeleton_trees(args: CommandLineArguments, workspace: str, for_cache: bool) -> None:
     if not args.skeleton_trees:
         return
 
     with complete_step('Copying in skeleton file trees'):
-        for d in args.skeleton_trees:
-            if os.path.isdir(d):
-                copy(d, os.path.join(workspace, "root"))
-            else:
-                shutil.unpack_archive(d, os.path.join(workspace, "root"))
+        _install_trees(args.skeleton_trees, os.path.join(workspace, "root"))
 
 def copy_git_files(src: str, dest: str, *, git_files: str) -> None:
     what_files = ['--exclude-standard', '--cached']
     if git_files == 'others':
         what_files += ['--others', '--exclude=.mkosi-*']
 
-    c = run_visible(['git', '-C', src, 'ls-files', '-z'] + what_files,
-                    stdout=PIPE,
-                    universal_newlines=False,
-                    check=True)
-    files = {x.decode("utf-8") for x in c.stdout.rstrip(b'\0').split(b'\0')}
-
-    # Get submodule files
-    c = run_visible(['git', '-C', src, 'submodule', 'status', '--recursive'],
-                    stdout=PIPE,
-                    universal_newlines=True,
-                    check=True)
-    submodules = {x.split()[1] for x in c.stdout.splitlines()}
-
-    # workaround for git-ls-files returning the path of submodules that we will
-    # still parse
-    files -= submodules
+    # The paths stay bytes all the way into tar(1), there is no need to
+    # decode them.
+    if git_files != 'others':
+        # A single git process lists the files of all (nested)
+        # submodules, too.
+        c = run_visible(['git', '-C', src, 'ls-files', '--recurse-submodules', '-z'] + what_files,
+                        stdout=PIPE,
+                        universal_newlines=False,
+                        check=True)
+        files = set(c.stdout.rstrip(b'\0').split(b'\0'))
+    else:
+        # --recurse-submodules only supports --cached, so with --others
+        # each submodule has to be listed separately.
+        c = run_visible(['git', '-C', src, 'ls-files', '-z'] + what_files,
+                        stdout=PIPE,
+                        universal_newlines=False,
+                        check=True)
+        files = set(c.stdout.rstrip(b'\0').split(b'\0'))
 
-    for sm in submodules:
-        c = run_visible(['git', '-C', os.path.join(src, sm), 'ls-files', '-z'] + what_files,
+        # Get submodule files
+        c = run_visible(['git', '-C', src, 'submodule', 'status', '--recursive'],
                         stdout=PIPE,
                         universal_newlines=False,
                         check=True)
-        files |= {os.path.join(sm, x.decode("utf-8"))for x in c.stdout.rstrip(b'\0').split(b'\0')}
-        files -= submodules
+        submodules = {x.split()[1] for x in c.stdout.splitlines()}
 
-    del c
+        # workaround for git-ls-files returning the path of submodules that we will
+        # still parse
+        files -= submodules
 
-    for path in files:
-        src_path = os.path.join(src, path)
-        dest_path = os.path.join(dest, path)
+        for sm in submodules:
+            c = run_visible(['git', '-C', os.path.join(src, os.fsdecode(sm)), 'ls-files', '-z'] + what_files,
+                            stdout=PIPE,
+                            universal_newlines=False,
+                            check=True)
+            files |= {os.path.join(sm, x) for x in c.stdout.rstrip(b'\0').split(b'\0')}
+            files -= submodules
 
-        directory = os.path.dirname(dest_path)
-        os.makedirs(directory, exist_ok=True)
+    del c
 
-        copy_file(src_path, dest_path)
+    # Let a tar(1) pipeline copy the whole list, rather than doing an
+    # open/clone/copystat round per file from Python. Unlike git
+    # archive, this picks up uncommitted changes, just like before.
+    os.makedirs(dest, exist_ok=True)
+    creator = popen_visible(["tar", "-C", src, "--null", "--no-recursion", "-T", "-", "-c", "-f", "-"],
+                            stdin=PIPE, stdout=PIPE)
+    stdin, stdout = creator.stdin, creator.stdout
+    assert stdin is not None and stdout is not None
+    extractor = None
+    try:
+        try:
+            extractor = popen_visible(["tar", "-C", dest, "--no-same-owner", "-x", "-f", "-"],
+                                      stdin=stdout)
+        finally:
+            # Only the extractor reads this, and if it couldn't be
+            # started, this makes the creator fail instead of block
+            stdout.close()
+        try:
+            stdin.write(b"".join(path + b"\0" for path in sorted(files)))
+        finally:
+            stdin.close()
+    except BrokenPipeError:
+        # The creating tar quit early, most likely because the extracting
+        # one did; their exit statuses say why
+        pass
+    finally:
+        stdin.close()
+        creator.wait()
+        if extractor is not None:
+            extractor.wait()
+    assert extractor is not None
+    # The extractor failing is what makes the creator fail, so report it
+    # first
+    if extractor.returncode != 0:
+        raise CalledProcessError(extractor.returncode, extractor.args)
+    if creator.returncode != 0:
+        raise CalledProcessError(creator.returncode, creator.args)
 
 def install_build_src(args: CommandLineArguments, workspace: str, run_build_script: bool, for_cache: bool) -> None:
     if not run_build_script:
@@ -896,22 +1079,23 @@ def make_tar(args: CommandLineArguments, workspace: str, run_build_script: bool,
 
     if run_build_script:
         return None
-    if args.output_format != OutputFormat.tar:
+    if args.output_format is not OutputFormat.tar:
         return None
     if for_cache:
         return None
 
     with complete_step('Creating archive'):
-        f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(dir=os.path.dirname(args.output), prefix=".mkosi-"))
+        f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(dir=args.output_dirname, prefix=".mkosi-"))
+        # xz is by far the slowest part here, so let it use all CPUs
         run_visible(["tar", "-C", os.path.join(workspace, "root"),
-                     "-c", "-J", "--xattrs", "--xattrs-include=*", "."],
+                     "-c", "--use-compress-program=" + " ".join(xz_command()), "--xattrs", "--xattrs-include=*", "."],
                     stdout=f, check=True)
 
     return f
 
 def make_squashfs(args: CommandLineArguments, workspace: str) -> BinaryIO:
     with complete_step('Creating squashfs file system'):
-        f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(dir=os.path.dirname(args.output), prefix=".mkosi-squashfs"))
+        f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(dir=args.output_dirname, prefix=".mkosi-squashfs"))
         run_visible(["mksquashfs", os.path.join(workspace, "root"), f.name, "-comp", "lz4", "-noappend"],
                     check=True)
 
@@ -932,7 +1116,7 @@ def insert_partition(args: CommandLineArguments, raw: BinaryIO, loopdev: str, pa
 
     print_step("Resizing disk image to {}...".format(format_bytes(new_size)))
 
-    os.truncate(raw.name, new_size)
+    resize_file(raw.fileno(), new_size)
     run_visible(["losetup", "--set-capacity", loopdev], check=True)
 
     print_step("Inserting partition of {}...".format(format_bytes(blob_size)))
@@ -955,7 +1139,11 @@ def insert_partition(args: CommandLineArguments, raw: BinaryIO, loopdev: str, pa
         dev = None
 
     try:
-        run_visible(["dd", "if=" + blob.name, "of=" + (dev if dev is not None else ensured_partition(loopdev, partno))], check=True)
+        # sendfile() moves the blob to the device in large chunks inside
+        # the kernel, unlike dd's default of 512 byte read()/write() pairs
+        with open_close(blob.name, os.O_RDONLY) as oldfd, \
+             open_close(dev if dev is not None else ensured_partition(loopdev, partno), os.O_WRONLY) as newfd:
+            copy_fd(oldfd, newfd)
     finally:
         luks_close(dev, "Closing LUKS root partition")
 
@@ -964,6 +1152,7 @@ def insert_partition(args: CommandLineArguments, raw: BinaryIO, loopdev: str, pa
     return blob_size
 
 def insert_squashfs(args: CommandLineArguments, raw: BinaryIO, loopdev: str, squashfs: BinaryIO) -> None:
+    assert args.root_partno is not None
     with complete_step('Inserting squashfs root partition'):
         args.root_size = insert_partition(args, raw, loopdev, args.root_partno, squashfs,
                                           "Root Partition", gpt_root_native().root)
@@ -971,7 +1160,11 @@ def insert_squashfs(args: CommandLineArguments, raw: BinaryIO, loopdev: str, squ
 def make_verity(args: CommandLineArguments, dev: str) -> Tuple[BinaryIO, str]:
 
     with complete_step('Generating verity hashes'):
-        f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(dir=os.path.dirname(args.output), prefix=".mkosi-"))
+        f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(dir=args.output_dirname, prefix=".mkosi-"))
+
+        if args.verity_builtin:
+            return f, verity_format(dev, f)
+
         c = run_visible(["veritysetup", "format", dev, f.name], stdout=PIPE, check=True)
 
         for line in c.stdout.decode("utf-8").split('\n'):
@@ -1034,9 +1227,10 @@ def install_unified_kernel(args: CommandLineArguments, workspace: str, run_build
         if root_hash is not None:
             cmdline += " roothash=" + root_hash
 
-        for kver in os.scandir(os.path.join(workspace, "root", "usr/lib/modules")):
-            if not kver.is_dir():
-                continue
+        with os.scandir(os.path.join(workspace, "root", "usr/lib/modules")) as it:
+            kvers = sorted((entry for entry in it if entry.is_dir()), key=lambda entry: entry.name)
+
+        for kver in kvers:
 
             boot_binary = "/efi/EFI/Linux/linux-" + kver.name
             if root_hash is not None:
@@ -1056,7 +1250,7 @@ def install_unified_kernel(args: CommandLineArguments, workspace: str, run_build
                       ("-i",) + ("/usr/lib/systemd/systemd-veritysetup",)*2 + \
                       ("-i",) + ("/usr/lib/systemd/system-generators/systemd-veritysetup-generator",)*2
 
-            if args.output_format == OutputFormat.raw_squashfs:
+            if args.output_format is OutputFormat.raw_squashfs:
                 dracut += [ '--add-drivers', 'squashfs' ]
 
             dracut += [ '--add', 'qemu' ]
@@ -1065,6 +1259,16 @@ def install_unified_kernel(args: CommandLineArguments, workspace: str, run_build
 
             run_workspace_command(args, workspace, *dracut)
 
+def secure_boot_sign_binary(args: CommandLineArguments, p: str) -> None:
+    run_visible(["sbsign",
+                 "--key", args.secure_boot_key,
+                 "--cert", args.secure_boot_certificate,
+                 "--output", p + ".signed",
+                 p],
+                check=True)
+
+    os.rename(p + ".signed", p)
+
 def secure_boot_sign(args: CommandLineArguments, workspace: str, run_build_script: bool, for_cache: bool) -> None:
 
     if run_build_script:
@@ -1076,22 +1280,42 @@ def secure_boot_sign(args: CommandLineArguments, workspace: str, run_build_scrip
     if for_cache:
         return
 
-    for path, dirnames, filenames in os.walk(os.path.join(workspace, "root", "efi")):
-        for i in filenames:
-            if not i.endswith(".efi") and not i.endswith(".EFI"):
-                continue
+    # Every EFI binary in the ESP gets signed, including those the
+    # distribution installed, so there is no shortcut around the walk.
+    # The ESP is small though; the time goes into sbsign, so run that
+    # for all binaries at once, reporting them as a single step so that
+    # the messages don't interleave.
+    binaries = [os.path.join(path, i)
+                for path, dirnames, filenames in os.walk(os.path.join(workspace, "root", "efi"))
+                for i in filenames
+                if i.endswith(".efi") or i.endswith(".EFI")]
+    if not binaries:
+        return
 
-            with complete_step("Signing EFI binary {} in ESP".format(i)):
-                p = os.path.join(path, i)
+    with complete_step("Signing EFI binaries {} in ESP".format(", ".join(os.path.basename(p) for p in binaries))):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(len(binaries), os.cpu_count() or 1)) as executor:
+            futures = [executor.submit(secure_boot_sign_binary, args, p) for p in binaries]
+        for f in futures:
+            f.result()
 
-                run_visible(["sbsign",
-                             "--key", args.secure_boot_key,
-                             "--cert", args.secure_boot_certificate,
-                             "--output", p + ".signed",
-                             p],
-                            check=True)
+@functools.lru_cache(maxsize=None)
+def xz_command() -> Tuple[str, ...]:
+    """The xz command line that compresses with as many threads as possible
 
-                os.rename(p + ".signed", p)
+    xz is multi-threaded by itself since 5.2, which beats pxz. The memory
+    limit makes xz use fewer threads rather than run out of memory on
+    machines with many CPUs.
+    """
+    try:
+        c = run_visible(["xz", "--version"], stdout=PIPE, universal_newlines=True, check=True)
+        m = re.match(r"xz \(XZ Utils\) (\d+)\.(\d+)", c.stdout)
+    except (OSError, CalledProcessError):
+        m = None
+    if m is not None and (int(m.group(1)), int(m.group(2))) >= (5, 2):
+        return ("xz", "-T0", "--memlimit-compress=50%")
+    if shutil.which("pxz"):
+        return ("pxz",)
+    return ("xz",)
 
 def xz_output(args: CommandLineArguments, raw: Optional[BinaryIO]) -> Optional[BinaryIO]:
     if args.output_format not in RAW_FORMATS:
@@ -1102,11 +1326,24 @@ def xz_output(args: CommandLineArguments, raw: Optional[BinaryIO]) -> Optional[B
 
     assert raw is not None
 
-    xz_binary = "pxz" if shutil.which("pxz") else "xz"
-
     with complete_step('Compressing image file'):
-        f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(prefix=".mkosi-", dir=os.path.dirname(args.output)))
-        run_visible([xz_binary, "-c", raw.name], stdout=f, check=True)
+        f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(prefix=".mkosi-", dir=args.output_dirname))
+        cmdline = list(xz_command())
+        if args.output_format is OutputFormat.raw_squashfs:
+            # The root file system is compressed already, so xz has little
+            # left to find beyond the zeroes; don't search hard for it.
+            cmdline += ["-0"]
+        # Hand xz the image as its stdin, so that it reads through our
+        # open file, on which the kernel has been told to read ahead
+        # aggressively.
+        raw.flush()
+        raw.seek(0)
+        os.posix_fadvise(raw.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        run_visible(cmdline + ["-c"], stdin=raw, stdout=f, check=True)
+
+    # Only the compressed image is needed from here on, release the disk
+    # space of the uncompressed one now rather than at the end of the build
+    raw.close()
 
     return f
 
@@ -1120,9 +1357,12 @@ def qcow2_output(args: CommandLineArguments, raw: Optional[BinaryIO]) -> Optiona
     assert raw is not None
 
     with complete_step('Converting image file to qcow2'):
-        f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(prefix=".mkosi-", dir=os.path.dirname(args.output)))
+        f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(prefix=".mkosi-", dir=args.output_dirname))
         run_visible(["qemu-img", "convert", "-fraw", "-Oqcow2", raw.name, f.name], check=True)
 
+    # The raw image isn't needed anymore, free its disk space right away
+    raw.close()
+
     return f
 
 def write_root_hash_file(args: CommandLineArguments, root_hash: Optional[str]) -> Optional[BinaryIO]:
@@ -1131,7 +1371,7 @@ def write_root_hash_file(args: CommandLineArguments, root_hash: Optional[str]) -
 
     with complete_step('Writing .roothash file'):
         f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(mode='w+b', prefix='.mkosi',
-                                                                 dir=os.path.dirname(args.output_root_hash_file)))
+                                                                 dir=args.output_dirname))
         f.write((root_hash + "\n").encode())
 
     return f
@@ -1142,24 +1382,56 @@ def copy_nspawn_settings(args: CommandLineArguments) -> Optional[BinaryIO]:
 
     with complete_step('Copying nspawn settings file'):
         f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(mode="w+b", prefix=".mkosi-",
-                                                                 dir=os.path.dirname(args.output_nspawn_settings)))
+                                                                 dir=args.output_dirname))
 
         with open(args.nspawn_settings, "rb") as c:
-            f.write(c.read())
+            copy_file_object(c, f)
 
     return f
 
-def hash_file(of: TextIO, sf: BinaryIO, fname: str) -> None:
-    bs = 16*1024**2
+SHA256_WINDOW = 64 * 1024 * 1024
+
+def sha256_file(sf: BinaryIO) -> str:
     h = hashlib.sha256()
 
-    sf.seek(0)
-    buf = sf.read(bs)
-    while len(buf) > 0:
-        h.update(buf)
-        buf = sf.read(bs)
+    # Hash the file through a read-only mapping, so that OpenSSL reads
+    # it without copies through Python. Going window by window, the
+    # kernel is asked to read the next window in the background while
+    # the current one is hashed, so the disk and the CPU work at the
+    # same time.
+    sf.flush()
+    fd = sf.fileno()
+    size = os.fstat(fd).st_size
+    if size == 0:
+        return h.hexdigest()
 
-    of.write(h.hexdigest() + " *" + fname + "\n")
+    try:
+        mm = mmap.mmap(fd, 0, prot=mmap.PROT_READ)
+    except (OSError, ValueError):
+        # Not mappable, or too big for the address space: read it
+        # instead, into one buffer that is reused for every chunk
+        os.lseek(fd, 0, os.SEEK_SET)
+        with memoryview(bytearray(SHA256_WINDOW)) as buf:
+            while True:
+                n = os.readv(fd, [buf])
+                if n == 0:
+                    break
+                h.update(buf[:n])
+        return h.hexdigest()
+
+    with mm:
+        can_madvise = hasattr(mm, "madvise")
+        if can_madvise:
+            mm.madvise(mmap.MADV_SEQUENTIAL)
+        with memoryview(mm) as view:
+            for start in range(0, size, SHA256_WINDOW):
+                end = start + SHA256_WINDOW
+                if can_madvise and end < size:
+                    mm.madvise(mmap.MADV_WILLNEED, end, min(SHA256_WINDOW, size - end))
+                with view[start:end] as window:
+                    h.update(window)
+
+    return h.hexdigest()
 
 def calculate_sha256sum(args: CommandLineArguments, raw: Optional[BinaryIO], tar: Optional[BinaryIO], root_hash_file: Optional[BinaryIO], nspawn_settings: Optional[BinaryIO]) -> Optional[TextIO]:
     if args.output_format in (OutputFormat.directory, OutputFormat.subvolume):
@@ -1170,16 +1442,25 @@ def calculate_sha256sum(args: CommandLineArguments, raw: Optional[BinaryIO], tar
 
     with complete_step('Calculating SHA256SUMS'):
         f: TextIO = cast(TextIO, tempfile.NamedTemporaryFile(mode="w+", prefix=".mkosi-", encoding="utf-8",
-                                                             dir=os.path.dirname(args.output_checksum)))
+                                                             dir=args.output_dirname))
 
+        files = []
         if raw is not None:
-            hash_file(f, raw, os.path.basename(args.output))
+            files.append((raw, os.path.basename(args.output)))
         if tar is not None:
-            hash_file(f, tar, os.path.basename(args.output))
+            files.append((tar, os.path.basename(args.output)))
         if root_hash_file is not None:
-            hash_file(f, root_hash_file, os.path.basename(args.output_root_hash_file))
+            files.append((root_hash_file, os.path.basename(args.output_root_hash_file)))
         if nspawn_settings is not None:
-            hash_file(f, nspawn_settings, os.path.basename(args.output_nspawn_settings))
+            files.append((nspawn_settings, os.path.basename(args.output_nspawn_settings)))
+
+        # hashlib drops the GIL while digesting, so the files can be
+        # hashed side by side.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(len(files), 1)) as executor:
+            digests = list(executor.map(sha256_file, [sf for sf, _ in files]))
+
+        f.write("".join(digest + " *" + fname + "\n" for digest, (_, fname) in zip(digests, files)))
+        f.flush()
 
     return f
 
@@ -1192,7 +1473,7 @@ def calculate_signature(args: CommandLineArguments, checksum: Optional[TextIO])
 
     with complete_step('Signing SHA256SUMS'):
         f: BinaryIO = cast(BinaryIO, tempfile.NamedTemporaryFile(mode="wb", prefix=".mkosi-",
-                                                                 dir=os.path.dirname(args.output_signature)))
+                                                                 dir=args.output_dirname))
 
         cmdline = ["gpg", "--detach-sign"]
 
@@ -1204,23 +1485,33 @@ def calculate_signature(args: CommandLineArguments, checksum: Optional[TextIO])
 
     return f
 
-def calculate_bmap(args: CommandLineArguments, raw: Optional[BinaryIO]) -> Optional[TextIO]:
-    if not args.bmap:
-        return None
-
-    if args.output_format not in RAW_RW_FS_FORMATS:
-        return None
+@contextlib.contextmanager
+def calculate_bmap(args: CommandLineArguments, raw: Optional[BinaryIO]) -> Iterator[Optional[TextIO]]:
+    """Create the BMAP file with bmaptool running in the background,
+    while the body of the with statement runs"""
+    if not args.bmap or args.output_format not in RAW_RW_FS_FORMATS:
+        yield None
+        return
 
     assert raw is not None
 
+    # The step is reported from this thread, around the body, so that
+    # its messages nest with the body's steps instead of interleaving
     with complete_step('Creating BMAP file'):
         f: TextIO = cast(TextIO, tempfile.NamedTemporaryFile(mode="w+", prefix=".mkosi-", encoding="utf-8",
-                                                             dir=os.path.dirname(args.output_bmap)))
+                                                             dir=args.output_dirname))
 
         cmdline = ["bmaptool", "create", raw.name]
-        run_visible(cmdline, stdout=f, check=True)
-
-    return f
+        proc = popen_visible(cmdline, stdout=f)
+        try:
+            yield f
+        except BaseException:
+            proc.kill()
+            raise
+        finally:
+            proc.wait()
+        if proc.returncode != 0:
+            raise CalledProcessError(proc.returncode, cmdline)
 
 def save_cache(args: CommandLineArguments, workspace: str, raw: Optional[str], cache_path: str) -> None:
 
@@ -1236,6 +1527,25 @@ def save_cache(args: CommandLineArguments, workspace: str, raw: Optional[str], c
         else:
             shutil.move(os.path.join(workspace, "root"), cache_path)
 
+def _link_output(path: str, dest: str, mode: int) -> None:
+    """Publish a finished temporary file under its final name"""
+    os.chmod(path, mode)
+    # Neither link() nor O_EXCL ever replace an existing file, so this is
+    # where check_output()'s up-front check is actually enforced.
+    try:
+        try:
+            os.link(path, dest)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            # Can't hard link across filesystems, fall back to a copy, which
+            # is a reflink where the filesystem allows it.
+            with open_close(path, os.O_RDONLY) as oldfd, \
+                 open_close(dest, os.O_WRONLY|os.O_CREAT|os.O_EXCL, mode) as newfd:
+                copy_fd(oldfd, newfd)
+    except FileExistsError:
+        die("Output file " + dest + " was created by someone else during the build.")
+
 def link_output(args: CommandLineArguments, workspace: str, raw: Optional[str], tar: Optional[str]) -> None:
     with complete_step('Linking image file',
                        'Successfully linked ' + args.output):
@@ -1243,12 +1553,10 @@ def link_output(args: CommandLineArguments, workspace: str, raw: Optional[str],
             os.rename(os.path.join(workspace, "root"), args.output)
         elif args.output_format in RAW_FORMATS:
             assert raw is not None
-            os.chmod(raw, 0o666 & ~args.original_umask)
-            os.link(raw, args.output)
+            _link_output(raw, args.output, 0o666 & ~args.original_umask)
         else:
             assert tar is not None
-            os.chmod(tar, 0o666 & ~args.original_umask)
-            os.link(tar, args.output)
+            _link_output(tar, args.output, 0o666 & ~args.original_umask)
 
 def link_output_nspawn_settings(args: CommandLineArguments, path: Optional[str]) -> None:
     if path is None:
@@ -1256,8 +1564,7 @@ def link_output_nspawn_settings(args: CommandLineArguments, path: Optional[str])
 
     with complete_step('Linking nspawn settings file',
                        'Successfully linked ' + args.output_nspawn_settings):
-        os.chmod(path, 0o666 & ~args.original_umask)
-        os.link(path, args.output_nspawn_settings)
+        _link_output(path, args.output_nspawn_settings, 0o666 & ~args.original_umask)
 
 def link_output_checksum(args: CommandLineArguments, checksum: Optional[str]) -> None:
     if checksum is None:
@@ -1265,8 +1572,7 @@ def link_output_checksum(args: CommandLineArguments, checksum: Optional[str]) ->
 
     with complete_step('Linking SHA256SUMS file',
                        'Successfully linked ' + args.output_checksum):
-        os.chmod(checksum, 0o666 & ~args.original_umask)
-        os.link(checksum, args.output_checksum)
+        _link_output(checksum, args.output_checksum, 0o666 & ~args.original_umask)
 
 def link_output_root_hash_file(args: CommandLineArguments, root_hash_file: Optional[str]) -> None:
     if root_hash_file is None:
@@ -1274,8 +1580,7 @@ def link_output_root_hash_file(args: CommandLineArguments, root_hash_file: Optio
 
     with complete_step('Linking .roothash file',
                        'Successfully linked ' + args.output_root_hash_file):
-        os.chmod(root_hash_file, 0o666 & ~args.original_umask)
-        os.link(root_hash_file, args.output_root_hash_file)
+        _link_output(root_hash_file, args.output_root_hash_file, 0o666 & ~args.original_umask)
 
 def link_output_signature(args: CommandLineArguments, signature: Optional[str]) -> None:
     if signature is None:
@@ -1283,8 +1588,7 @@ def link_output_signature(args: CommandLineArguments, signature: Optional[str])
 
     with complete_step('Linking SHA256SUMS.gpg file',
                        'Successfully linked ' + args.output_signature):
-        os.chmod(signature, 0o666 & ~args.original_umask)
-        os.link(signature, args.output_signature)
+        _link_output(signature, args.output_signature, 0o666 & ~args.original_umask)
 
 def link_output_bmap(args: CommandLineArguments, bmap: Optional[str]) -> None:
     if bmap is None:
@@ -1292,21 +1596,30 @@ def link_output_bmap(args: CommandLineArguments, bmap: Optional[str]) -> None:
 
     with complete_step('Linking .bmap file',
                        'Successfully linked ' + args.output_bmap):
-        os.chmod(bmap, 0o666 & ~args.original_umask)
-        os.link(bmap, args.output_bmap)
+        _link_output(bmap, args.output_bmap, 0o666 & ~args.original_umask)
 
 def dir_size(path: str) -> int:
     sum = 0
-    for entry in os.scandir(path):
-        if entry.is_symlink():
-            # We can ignore symlinks because they either point into our tree,
-            # in which case we'll include the size of target directory anyway,
-            # or outside, in which case we don't need to.
-            continue
-        elif entry.is_file():
-            sum += entry.stat().st_blocks * 512
-        elif entry.is_dir():
-            sum += dir_size(entry.path)
+    # Walk the tree with an explicit stack rather than recursion. The
+    # entry types come from scandir() for free, so only regular files
+    # need a stat() call, for their block count.
+    todo = [path]
+    while todo:
+        with os.scandir(todo.pop()) as it:
+            for entry in it:
+                if entry.is_symlink():
+                    # We can ignore symlinks because they either point into our tree,
+                    # in which case we'll include the size of target directory anyway,
+                    # or outside, in which case we don't need to.
+                    continue
+                elif entry.is_file(follow_symlinks=False):
+                    try:
+                        sum += entry.stat(follow_symlinks=False).st_blocks * 512  # type: ignore # mypy 0.641 doesn't know about follow_symlinks
+                    except FileNotFoundError:
+                        # Removed since it was listed, so it takes no space
+                        pass
+                elif entry.is_dir(follow_symlinks=False):
+                    todo.append(entry.path)
     return sum
 
 def print_output_size(args: CommandLineArguments) -> None:
@@ -1322,7 +1635,7 @@ def setup_package_cache(args: CommandLineArguments) -> Iterator[str]:
     with complete_step('Setting up package cache',
                        'Setting up package cache {} complete') as output:
         if args.cache_path is None:
-            d = tempfile.TemporaryDirectory(dir=os.path.dirname(args.output), prefix=".mkosi-")
+            d = tempfile.TemporaryDirectory(dir=args.output_dirname, prefix=".mkosi-")
             args.cache_path = d.name
         else:
             os.makedirs(args.cache_path, 0o755, exist_ok=True)
@@ -1368,11 +1681,16 @@ def reuse_cache_tree(args: CommandLineArguments, workspace: str, run_build_scrip
     if fname is None:
         return False
 
+    if not os.path.isdir(fname):
+        return False
+
     with complete_step('Copying in cached tree ' + fname):
-        try:
-            copy(fname, os.path.join(workspace, "root"))
-        except FileNotFoundError:
-            return False
+        # The cached tree is a whole OS tree, so let cp(1) do the per-file
+        # work in C rather than copy() in Python. It reflinks where it can,
+        # and unlike copy() it also keeps ownership, hard links and device
+        # nodes.
+        run_visible(["cp", "-a", "--reflink=auto", "-T", fname, os.path.join(workspace, "root")],
+                    check=True)
 
     return True
 
@@ -1409,9 +1727,6 @@ def build_image(args: CommandLineArguments, workspace: str, run_build_script: bo
 
     with attach_image_loopback(args, raw) as loopdev:
 
-        prepare_swap(args, loopdev, cached)
-        prepare_esp(args, loopdev, cached)
-
         if loopdev is not None:
             luks_format_root(args, loopdev, run_build_script, cached)
             luks_format_home(args, loopdev, run_build_script, cached)
@@ -1419,9 +1734,7 @@ def build_image(args: CommandLineArguments, workspace: str, run_build_script: bo
 
         with luks_setup_all(args, loopdev, run_build_script) as (encrypted_root, encrypted_home, encrypted_srv):
 
-            prepare_root(args, encrypted_root, cached)
-            prepare_home(args, encrypted_home, cached)
-            prepare_srv(args, encrypted_srv, cached)
+            prepare_partitions(args, loopdev, encrypted_root, encrypted_home, encrypted_srv, cached)
 
             with mount_image(args, workspace, loopdev, encrypted_root, encrypted_home, encrypted_srv):
                 prepare_tree(args, workspace, run_build_script, cached)
@@ -1445,8 +1758,8 @@ def build_image(args: CommandLineArguments, workspace: str, run_build_script: bo
 
             root_hash: Optional[str] = None
             if not for_cache:
-                if args.output_format == OutputFormat.raw_squashfs and not for_cache:
-                    # args.output_format == OutputFormat.raw_*
+                if args.output_format is OutputFormat.raw_squashfs and not for_cache:
+                    # args.output_format is OutputFormat.raw_*
                     # -> implies: raw is not None
                     # -> implies: loopdev is not None
                     assert raw is not None
@@ -1484,20 +1797,13 @@ def run_build_script(args: CommandLineArguments, workspace: str, raw: Optional[B
         dest = os.path.join(workspace, "dest")
         os.mkdir(dest, 0o755)
 
-        target = "--directory=" + os.path.join(workspace, "root") if raw is None else "--image=" + raw.name
-
-        cmdline = ["systemd-nspawn",
-                   '--quiet',
-                   target,
-                   "--uuid=" + args.machine_id,
-                   "--machine=mkosi-" + uuid.uuid4().hex,
-                   "--as-pid2",
-                   "--register=no",
-                   "--bind", dest + ":/root/dest",
-                   "--bind=" + var_tmp(workspace) + ":/var/tmp",
-                   "--setenv=WITH_DOCS=" + ("1" if args.with_docs else "0"),
-                   "--setenv=WITH_TESTS=" + ("1" if args.with_tests else "0"),
-                   "--setenv=DESTDIR=/root/dest"]
+        target = None if raw is None else "--image=" + raw.name
+
+        cmdline = nspawn_cmdline(args, workspace, target=target, network=args.with_network,
+                                 env={"WITH_DOCS": "1" if args.with_docs else "0",
+                                      "WITH_TESTS": "1" if args.with_tests else "0",
+                                      "DESTDIR": "/root/dest"})
+        cmdline += ["--bind", dest + ":/root/dest"]
 
         if args.build_sources is not None:
             cmdline.append("--setenv=SRCDIR=/root/src")
@@ -1512,14 +1818,8 @@ def run_build_script(args: CommandLineArguments, workspace: str, raw: Optional[B
             cmdline.append("--setenv=BUILDDIR=/root/build")
             cmdline.append("--bind=" + args.build_dir + ":/root/build")
 
-        if args.with_network:
-            # If we're using the host network namespace, use the same resolver
-            cmdline.append("--bind-ro=/etc/resolv.conf")
-        else:
-            cmdline.append("--private-network")
-
         cmdline.append("/root/" + os.path.basename(args.build_script))
-        run_visible(cmdline, check=True)
+        spawn_visible(cmdline, check=True)
 
 def need_cache_images(args: CommandLineArguments) -> bool:
 
@@ -1550,7 +1850,7 @@ def remove_artifacts(args: CommandLineArguments, workspace: str, raw: Optional[B
 
     with complete_step("Removing artifacts from " + what):
         unlink_try_hard(os.path.join(workspace, "root"))
-        unlink_try_hard(os.path.join(workspace, "var-tmp"))
+        remove_var_tmp(workspace)
 
 def build_stuff(args: CommandLineArguments) -> None:
 
@@ -1609,9 +1909,11 @@ def _build_stuff(args: CommandLineArguments, workspace: str) -> None:
     raw = xz_output(args, raw)
     root_hash_file = write_root_hash_file(args, root_hash)
     settings = copy_nspawn_settings(args)
-    checksum = calculate_sha256sum(args, raw, tar, root_hash_file, settings)
-    signature = calculate_signature(args, checksum)
-    bmap = calculate_bmap(args, raw)
+    # bmaptool only reads the final image, so it can run while the
+    # checksums are calculated and signed.
+    with calculate_bmap(args, raw) as bmap:
+        checksum = calculate_sha256sum(args, raw, tar, root_hash_file, settings)
+        signature = calculate_signature(args, checksum)
 
     link_output(args,
                 workspace,
@@ -1642,7 +1944,7 @@ def do(args: CommandLineArguments) -> None:
     dirs = [
         args.build_sources,
         args.cache_path,
-        os.path.dirname(args.output),
+        args.output_dirname,
     ]
     # Normalize
     dirs = [os.path.abspath(d) for d in dirs if d is not None]
@@ -5,7 +5,7 @@ import shutil
 
 from ..docker import run_in_docker
 from ..types import CommandLineArguments
-from .build import init_namespace
+from .build import copy_fd, init_namespace, open_close
 from .withmount import osi_mount
 
 NEEDS_ROOT = False
@@ -16,8 +16,11 @@ FORCE_UNLINKS = False
 def do_inner(args: CommandLineArguments) -> None:
     init_namespace(args)
     with osi_mount(args) as mountpoint:
-        shutil.copyfile(os.path.join(mountpoint, "var/log/testbench-run.tap"),
-                        args.output[:-4])  # .tap.osi → .tap
+        # Only the contents, like shutil.copyfile(): the in-image file's
+        # mode, timestamps and xattrs have no business on the host.
+        with open_close(os.path.join(mountpoint, "var/log/testbench-run.tap"), os.O_RDONLY) as oldfd, \
+             open_close(args.output[:-4], os.O_WRONLY|os.O_CREAT|os.O_TRUNC, 0o666) as newfd:  # .tap.osi → .tap
+            copy_fd(oldfd, newfd)
         shutil.rmtree(args.output[:-8]+".cache", ignore_errors=True)
         for cachedir in [os.path.join("/", d) for d in args.runcache]:
             host = args.output[:-8]+".cache"+cachedir
@@ -0,0 +1,82 @@
+# SPDX-License-Identifier: LGPL-2.1+
+
+import hashlib
+import mmap
+import os
+import struct
+import uuid
+from typing import BinaryIO, List
+
+from .ui import die
+
+# The layout "veritysetup format" produces with its defaults: format
+# version 1, SHA-256 with a 32 byte random salt, 4 KiB data and hash
+# blocks, and a superblock in front of the hash tree.
+VERITY_BLOCK_SIZE = 4096
+VERITY_SALT_SIZE = 32
+VERITY_DIGEST_SIZE = 32
+VERITY_HASHES_PER_BLOCK = VERITY_BLOCK_SIZE // VERITY_DIGEST_SIZE
+# struct verity_sb from cryptsetup's lib/verity/verity.c
+VERITY_SUPERBLOCK = struct.Struct("<8sII16s32sIIQH6x256s168x")
+
+def _level_sizes(data_blocks: int) -> List[int]:
+    """Number of hash blocks on each tree level, the one hashing the data first"""
+    sizes = []
+    n = data_blocks
+    while n > 1:
+        n = (n + VERITY_HASHES_PER_BLOCK - 1) // VERITY_HASHES_PER_BLOCK
+        sizes.append(n)
+    return sizes
+
+def _hash_blocks(salt: bytes, data: memoryview, count: int) -> bytes:
+    """Hash count blocks of data, returning the digests packed into zero-padded hash blocks"""
+    # Version 1 hashes the salt first, so its state can be computed once
+    # and copied for every block
+    salted = hashlib.sha256(salt)
+    digests = []
+    for i in range(count):
+        h = salted.copy()
+        h.update(data[i * VERITY_BLOCK_SIZE:(i + 1) * VERITY_BLOCK_SIZE])
+        digests.append(h.digest())
+    level = b"".join(digests)
+    return level + bytes(-len(level) % VERITY_BLOCK_SIZE)
+
+def verity_format(dev: str, hash_file: BinaryIO) -> str:
+    """Write the dm-verity hash tree of dev to hash_file, in-process
+
+    Produces the same layout as "veritysetup format dev hash_file" and
+    returns the root hash as a hex string.
+    """
+    with open(dev, "rb") as f:
+        size = f.seek(0, os.SEEK_END)
+        data_blocks = size // VERITY_BLOCK_SIZE
+        if data_blocks == 0:
+            die("Device {} is too small for verity".format(dev))
+
+        salt = os.urandom(VERITY_SALT_SIZE)
+        levels = []
+        with mmap.mmap(f.fileno(), data_blocks * VERITY_BLOCK_SIZE, prot=mmap.PROT_READ) as mm:
+            if hasattr(mm, "madvise"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            with memoryview(mm) as view:
+                below = view
+                count = data_blocks
+                for n in _level_sizes(data_blocks):
+                    levels.append(_hash_blocks(salt, below, count))
+                    below = memoryview(levels[-1])
+                    count = n
+                # The top level is a single block (or the data itself, if
+                # that is only a single block), whose hash is the root hash
+                root_hash = _hash_blocks(salt, below, 1)[:VERITY_DIGEST_SIZE]
+                del below
+
+    hash_file.write(VERITY_SUPERBLOCK.pack(b"verity\0\0", 1, 1, uuid.uuid4().bytes, b"sha256",
+                                           VERITY_BLOCK_SIZE, VERITY_BLOCK_SIZE, data_blocks,
+                                           VERITY_SALT_SIZE, salt))
+    hash_file.write(bytes(VERITY_BLOCK_SIZE - VERITY_SUPERBLOCK.size))
+    # The tree is stored top level first
+    for level in reversed(levels):
+        hash_file.write(level)
+    hash_file.flush()
+
+    return root_hash.hex()
@@ -1,33 +1,51 @@
+import concurrent.futures
 import html
 import pkgutil
 import sys
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple, cast
 
 from .tap import TestCase, TestStatus
 from .tap import parse as tap_parse
 
-HEAD = pkgutil.get_data(__package__, 'head.html').decode('utf-8')
-TAIL = pkgutil.get_data(__package__, 'tail.html').decode('utf-8')
+def load_data(name: str) -> bytes:
+    data = pkgutil.get_data(__package__, name)
+    if data is None:
+        raise FileNotFoundError(name)
+    return data
 
-# mypy doesn't like html.escape()
-def html_escape(i: str, quote: bool) -> str:
-    return html.escape(i, quote=quote)
+
+# Kept as the UTF-8 bytes they are stored as, to be written out as-is
+HEAD = load_data('head.html')
+TAIL = load_data('tail.html')
 
 erred = False
 
-def print_cell(s: TestStatus) -> None:
+# The rendered cell for each status, and whether it counts as passing;
+# indexed by the status itself, so this must follow TestStatus's order
+CELLS: Tuple[Tuple[str, bool], ...] = tuple(
+    ('    <td class="%s">%s</td>' % (classes, text), passed)
+    for classes, text, passed in (
+        ("ok", "✔", True),             # OK
+        ("not_ok", "✘", False),        # NOT_OK
+        ("todo_ok", "✔", True),        # TODO_OK
+        ("todo_not_ok", "✘", True),    # TODO_NOT_OK
+        ("skip", "-", True),           # SKIP
+        ("missing", "❗", False),       # MISSING
+    )
+)
+assert len(CELLS) == len(TestStatus)
+
+def render_cell(s: TestStatus) -> str:
     global erred
-    classes, text, passed = {
-        TestStatus.OK: ("ok", "✔", True),
-        TestStatus.NOT_OK: ("not_ok", "✘", False),
-        TestStatus.TODO_OK: ("todo_ok", "✔", True),
-        TestStatus.TODO_NOT_OK: ("todo_not_ok", "✘", True),
-        TestStatus.SKIP: ("skip", "-", True),
-        TestStatus.MISSING: ("missing", "❗", False),
-    }[s]
+    cell, passed = CELLS[s]
     if not passed:
         erred = True
-    print('    <td class="%s">%s</td>' % (classes, text))
+    return cell
+
+
+def parse_file(filename: str) -> Tuple[Dict[int, TestCase], List[str]]:
+    with open(filename, mode="rt", encoding="utf-8") as file:
+        return tap_parse(file)
 
 
 def main() -> None:
@@ -37,78 +55,101 @@ def main() -> None:
     filenames = sys.argv[1:]
     file_cases: Dict[str, Dict[int, TestCase]] = {}
     file_errs: Dict[str, List[str]] = {}
-    for filename in filenames:
-        with open(filename, mode="rt", encoding="utf-8") as file:
-            file_cases[filename], file_errs[filename] = tap_parse(file)
+    # Overlap reading the files; the results still come back in order
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(32, len(filenames))) as executor:
+        for filename, (cases, errs) in zip(filenames, executor.map(parse_file, filenames)):
+            file_cases[filename], file_errs[filename] = cases, errs
 
     # Decide what we'll pretend the canonical list of testcase names is
-    longest_len = max(len(cases) for cases in file_cases.values())
-    for filename in filenames:
-        if len(file_cases[filename]) == longest_len:
-            break
-    testcase_names: List[Optional[str]] = [file_cases[filename][i].description for i in range(1, longest_len+1)]
-    # Check if everything agrees with that
+    # (max() picks the first of several equally long ones)
+    canonical = max(filenames, key=lambda filename: len(file_cases[filename]))
+    longest_len = len(file_cases[canonical])
+    testcase_names: List[Optional[str]] = [file_cases[canonical][i].description for i in range(1, longest_len+1)]
+    # Check if everything agrees with that, and lay each file's test case
+    # statuses out as a dense list, indexed by test number - 1.  Whether
+    # the suite ran and passed is settled on that list right away, rather
+    # than by going through all of a file's test cases again later.
+    MISSING, NOT_OK = TestStatus.MISSING, TestStatus.NOT_OK
+    file_statuses: List[List[TestStatus]] = []
+    file_ran: Dict[str, bool] = {}
+    file_passed: Dict[str, bool] = {}
     for filename in filenames:
-        prepend: List[str] = []
-        for i in range(1, longest_len+1):
-            if i in file_cases[filename]:
-                expected = testcase_names[i-1]
-                actual = file_cases[filename][i].description
-                if actual != expected:
-                    prepend.append("%s: test %d: mismatched description: expected=%s actual=%s" % (filename, i, repr(expected), repr(actual)))
-            else:
-                file_cases[filename][i] = TestCase(status=TestStatus.MISSING, n=i)
-                prepend.append("%s: test %d: missing" % (filename, i))
-        if len(prepend) > 0:
-            file_errs[filename] = prepend + file_errs[filename]
+        cases = file_cases[filename]
+        # Usually a file has every test case, under the expected name;
+        # establish that with list operations that run in C, and only
+        # go case by case to pin down what's wrong otherwise.
+        found = [cases.get(i) for i in range(1, longest_len+1)]
+        if None not in found and [tc.description for tc in cast(List[TestCase], found)] == testcase_names:
+            case_row = cast(List[TestCase], found)
+        else:
+            case_row = []
+            prepend: List[str] = []
+            for i in range(1, longest_len+1):
+                tc = cases.get(i)
+                if tc is not None:
+                    expected = testcase_names[i-1]
+                    actual = tc.description
+                    if actual != expected:
+                        prepend.append("%s: test %d: mismatched description: expected=%s actual=%s" % (filename, i, repr(expected), repr(actual)))
+                else:
+                    tc = cases[i] = TestCase(status=MISSING, n=i)
+                    prepend.append("%s: test %d: missing" % (filename, i))
+                case_row.append(tc)
+            if len(prepend) > 0:
+                file_errs[filename] = prepend + file_errs[filename]
+        statuses = [tc.status for tc in case_row]
+        file_statuses.append(statuses)
+        # The parser fills in gaps with MISSING too, so look for it in the
+        # statuses rather than only noting the ones inserted above
+        file_ran[filename] = len(file_errs[filename]) == 0 and MISSING not in statuses
+        file_passed[filename] = file_ran[filename] and NOT_OK not in statuses
 
-    # Now print everything
-    print(HEAD)
-    print("<table>")
+    # Now print everything, collecting the lines to write them all at once
+    out: List[str] = []
+    out.append("<table>")
     # The table header
-    print("  <tr>")
-    print("    <td></td>")
-    for filename in filenames:
-        print('    <th><div><a href="%s">%s</a></div></th>' % (
-            html_escape(filename, quote=False),
-            html_escape(filename, quote=True)))
-    print("  </tr>")
+    out.append("  <tr>")
+    out.append("    <td></td>")
+    escaped_filenames = [(html.escape(filename, quote=False), html.escape(filename, quote=True))
+                         for filename in filenames]
+    for href, text in escaped_filenames:
+        out.append('    <th><div><a href="%s">%s</a></div></th>' % (href, text))
+    out.append("  </tr>")
     # Print whether there are problems with this TAP
-    print("  <tr>")
-    print("    <th>Tests suite ran</th>")
+    out.append("  <tr>")
+    out.append("    <th>Tests suite ran</th>")
     for filename in filenames:
-        ok = (
-            (len(file_errs[filename]) == 0) and
-            all(tc.status != TestStatus.MISSING for tc in file_cases[filename].values())
-        )
-        print_cell(TestStatus.OK if ok else TestStatus.NOT_OK)
-    print("  </tr>")
+        out.append(render_cell(TestStatus.OK if file_ran[filename] else NOT_OK))
+    out.append("  </tr>")
     # Print the test suite status
-    print("  <tr>")
-    print("    <th>Tests suite passed</th>")
+    out.append("  <tr>")
+    out.append("    <th>Tests suite passed</th>")
     for filename in filenames:
-        ok = (
-            (len(file_errs[filename]) == 0) and
-            all(tc.status != TestStatus.MISSING and tc.status != TestStatus.NOT_OK for tc in file_cases[filename].values())
-        )
-        print_cell(TestStatus.OK if ok else TestStatus.NOT_OK)
-    print("  </tr>")
-    # Print each test case
-    for i in range(1, longest_len+1):
-        print("  <tr>")
-        print("    <th>%d: %s</th>" % (i, html_escape(testcase_names[i-1] or "", quote=False)))
-        for filename in filenames:
-            print_cell(file_cases[filename][i].status)
-        print("  </tr>")
+        out.append(render_cell(TestStatus.OK if file_passed[filename] else NOT_OK))
+    out.append("  </tr>")
+    # Print each test case, going through the statuses row by row rather
+    # than looking each cell up by filename and test number
+    row_headers = ["    <th>%d: %s</th>" % (i, html.escape(name or "", quote=False))
+                   for i, name in enumerate(testcase_names, 1)]
+    for header, row_statuses in zip(row_headers, zip(*file_statuses)):
+        out.append("  <tr>")
+        out.append(header)
+        out.extend(map(render_cell, row_statuses))
+        out.append("  </tr>")
     # End table
-    print("</table>")
+    out.append("</table>")
     # Display any errors
     if any(len(errs) > 0 for _, errs in file_errs.items()):
-        print("<pre>")
+        out.append("<pre>")
         for filename in filenames:
             for err in file_errs[filename]:
-                print(html_escape(err, quote=False))
-        print("</pre>")
-    # End document
-    print(TAIL)
-    print("<!-- exit: {} -->".format(1 if erred else 0))
+                out.append(html.escape(err, quote=False))
+        out.append("</pre>")
+    # Write the document straight to the binary stdout, encoding the
+    # table once rather than going through the text layer
+    stdout = sys.stdout.buffer
+    stdout.write(HEAD + b"\n")
+    stdout.write(("\n".join(out) + "\n").encode("utf-8"))
+    stdout.write(TAIL + b"\n")
+    stdout.write(b"<!-- exit: %d -->\n" % (1 if erred else 0))
+    stdout.flush()
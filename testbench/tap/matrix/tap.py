@@ -1,4 +1,4 @@
-from enum import Enum
+from enum import IntEnum
 from typing import (
     Any,
     Callable,
@@ -24,13 +24,14 @@ def trim_prefix(s: str, prefix: str) -> str:
     return s
 
 
-class TestStatus(Enum):
-    OK = 1
-    NOT_OK = 2
-    TODO_OK = 3
-    TODO_NOT_OK = 4
-    SKIP = 5
-    MISSING = 6
+# An IntEnum numbered from 0, so that a status can directly index a tuple
+class TestStatus(IntEnum):
+    OK = 0
+    NOT_OK = 1
+    TODO_OK = 2
+    TODO_NOT_OK = 3
+    SKIP = 4
+    MISSING = 5
 
 
 class TestCase(NamedTuple):
@@ -0,0 +1,61 @@
+import shutil
+import subprocess
+import uuid
+from pathlib import Path
+from typing import Dict, List
+
+import pytest
+
+from testbench.mkosi.gpt import (
+    GPT_ESP,
+    GPT_HOME,
+    GPT_ROOT_X86_64,
+    GPT_SECTOR_SIZE,
+    Partition,
+    write_partition_table,
+)
+
+pytestmark = pytest.mark.skipif(shutil.which("sfdisk") is None, reason="needs sfdisk")
+
+# Deliberately not a multiple of the 1 MiB alignment, so that the last
+# partition's end is distinguishable from a rounded-down one
+DISK_SIZE = 70*1024*1024 + 17*GPT_SECTOR_SIZE
+
+def make_disk(path: Path) -> str:
+    with path.open("wb") as f:
+        f.truncate(DISK_SIZE)
+    return str(path)
+
+def sfdisk_dump(path: str) -> List[str]:
+    out = subprocess.run(["sfdisk", "--dump", path], stdout=subprocess.PIPE, check=True,
+                         env={"LC_ALL": "C", "PATH": "/usr/sbin:/usr/bin:/sbin:/bin"}).stdout.decode("utf-8")
+    # The disk GUID is random, and the partitions are named after the file
+    lines = []
+    for line in out.splitlines():
+        if line.startswith(("label-id:", "device:")):
+            continue
+        lines.append(line.replace(path, "DISK"))
+    return lines
+
+def check_same_as_sfdisk(tmp_path: Path, table: Dict[int, Partition]) -> None:
+    expected = make_disk(tmp_path / "sfdisk.img")
+    script = "label: gpt\n" + "".join(str(p) + "\n" for _, p in sorted(table.items()))
+    subprocess.run(["sfdisk", "--color=never", "--quiet", expected], input=script.encode("utf-8"), check=True)
+
+    actual = make_disk(tmp_path / "packed.img")
+    write_partition_table(actual, table)
+
+    assert sfdisk_dump(actual) == sfdisk_dump(expected)
+
+def test_fill_partition_runs_to_last_usable_sector(tmp_path: Path) -> None:
+    check_same_as_sfdisk(tmp_path, {
+        1: Partition(p_size=20*2048, p_type=GPT_ESP, p_uuid=uuid.uuid4(), p_name="ESP System Partition"),
+        2: Partition(p_type=GPT_ROOT_X86_64, p_uuid=uuid.uuid4(), p_name="Root Partition", p_attrs="GUID:60"),
+    })
+
+def test_sized_partitions(tmp_path: Path) -> None:
+    check_same_as_sfdisk(tmp_path, {
+        1: Partition(p_size=20*2048, p_type=GPT_ESP, p_uuid=uuid.uuid4(), p_name="ESP System Partition"),
+        2: Partition(p_size=10*2048, p_type=GPT_HOME, p_uuid=uuid.uuid4(), p_name="Home Partition"),
+        3: Partition(p_size=30*2048, p_type=GPT_ROOT_X86_64, p_uuid=uuid.uuid4(), p_name="Root Partition"),
+    })